@@ -1,4 +1,5 @@
 import logging
+import concurrent.futures
 import requests
 import json
 import random
@@ -8,9 +9,16 @@ from pathlib import Path
 from getpass import getpass
 
 from filters import Filter
-from downloader import download_scenes
+from downloader import download_scenes, available_locally, DownloadScheduler
 
 M2M_ENDPOINT = 'https://m2m.cr.usgs.gov/api/api/json/{}/'
+poll_min_seconds = 2
+poll_max_seconds = 60
+poll_timeout_seconds = 6 * 3600
+bulk_chunk_size = 500
+bulk_max_workers = 4
+bulk_max_retries = 3
+bulk_retry_seconds = 5
 logging.getLogger('requests').setLevel(logging.WARNING)
 
 class M2MError(Exception):
@@ -110,6 +118,37 @@ class M2M(object):
         response.close()
         return output['data']
 
+    def sendChunkedRequest(self, endpoint, data, key, items, chunk_size=bulk_chunk_size, max_workers=bulk_max_workers, max_retries=bulk_max_retries):
+        """
+        Send a bulk request in chunks of at most chunk_size items of data[key], at most max_workers at a time.
+
+        Each chunk is retried on its own with exponential backoff, so a failing chunk does not
+        throw away the others. Returns the outputs of every chunk in order.
+        """
+        chunks = [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)] or [items]
+        def send(chunk_index):
+            chunk_data = dict(data)
+            chunk_data[key] = chunks[chunk_index]
+            retries = 0
+            while True:
+                try:
+                    output = self.sendRequest(endpoint, chunk_data)
+                    logging.info('M2M.sendChunkedRequest - {} - chunk {} of {} done'.format(endpoint, chunk_index+1, len(chunks)))
+                    return output
+                except (M2MError, requests.exceptions.RequestException) as e:
+                    if retries >= max_retries:
+                        raise
+                    retries += 1
+                    sec = (random.random() + 1.) * bulk_retry_seconds * 2**(retries-1)
+                    logging.warning('M2M.sendChunkedRequest - {} - chunk {} of {} failed ({}), retry number {} of {} in {:.1f} seconds'.format(
+                        endpoint, chunk_index+1, len(chunks), e, retries, max_retries, sec))
+                    time.sleep(sec)
+        if len(chunks) == 1:
+            return [send(0)]
+        logging.info('M2M.sendChunkedRequest - {} - sending {} items in {} chunks'.format(endpoint, len(items), len(chunks)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(send, range(len(chunks))))
+
     def login(self, password=None):
         if password is None:
             raise M2MError('password not provided')
@@ -151,7 +190,10 @@ class M2M(object):
         if datasetName not in self.datasetNames:
             raise M2MError("Dataset {} not one of the available datasets {}".format(datasetName,self.datasetNames))
         args['datasetName'] = datasetName
-        self.sendRequest('scene-list-add', args)
+        if 'entityIds' in args:
+            self.sendChunkedRequest('scene-list-add', args, 'entityIds', args['entityIds'])
+        else:
+            self.sendRequest('scene-list-add', args)
     
     def sceneListGet(self, listId, **args):
         args['listId'] = listId
@@ -165,14 +207,18 @@ class M2M(object):
         if datasetName not in self.datasetNames:
             raise M2MError("Dataset {} not one of the available datasets {}".format(datasetName,self.datasetNames))
         args['datasetName'] = datasetName
-        downloadOptions = self.sendRequest('download-options', args)
+        if 'entityIds' in args:
+            downloadOptions = []
+            for chunkOptions in self.sendChunkedRequest('download-options', args, 'entityIds', args['entityIds']):
+                downloadOptions += chunkOptions or []
+        else:
+            downloadOptions = self.sendRequest('download-options', args)
         filteredOptions = apply_filter(downloadOptions, filterOptions)
         return filteredOptions
             
     def downloadRequest(self, downloadList, label='m2m-api_download'):
-        params = {'downloads': downloadList,
-                'label': label}
-        return self.sendRequest('download-request', params)
+        params = {'label': label}
+        return merge_outputs(self.sendChunkedRequest('download-request', params, 'downloads', downloadList))
 
     def downloadRetrieve(self, label='m2m-api_download'):
         params = {'label': label}
@@ -188,7 +234,20 @@ class M2M(object):
         params = {'label': label}
         self.sendRequest('download-order-remove', params)
 
-    def retrieveScenes(self, datasetName, scenes, filterOptions={}, label='m2m-api_download'):
+    def downloadMetadata(self, labels, downloadMeta):
+        for label in labels:
+            downloadSearch = self.downloadSearch(label)
+            if downloadSearch is not None:
+                for ds in downloadSearch:
+                    downloadMeta.setdefault(str(ds['downloadId']), {}).update(ds)
+
+    def retrieveScenes(self, datasetName, scenes, filterOptions={}, label='m2m-api_download', acq_directory=None):
+        """
+        Order the products of scenes under label and download them as they become available.
+
+        :return: dictionary of metadata by downloadId, with an 'error' entry for downloads that
+            failed ('download failed') or never became available ('not available')
+        """
         entityIds = [scene['entityId'] for scene in scenes['results']]
         self.sceneListAdd(label, datasetName, entityIds=entityIds)
         downloadMeta = {}
@@ -200,34 +259,63 @@ class M2M(object):
         requestedDownloadsCount = len(downloads)
         if requestedDownloadsCount:
             logging.info('M2M.retrieveScenes - Requested downloads count={}'.format(requestedDownloadsCount))
-            requestResults = self.downloadRequest(downloads)
+            requestResults = self.downloadRequest(downloads, label)
             if len(requestResults['duplicateProducts']):
                 for product in requestResults['duplicateProducts'].values():
                     if product not in labels:
                         labels.append(product)
-            for label in labels:
-                downloadSearch = self.downloadSearch(label)
-                if downloadSearch is not None:
-                    for ds in downloadSearch:
-                        downloadMeta.update({str(ds['downloadId']): ds})
-            if requestResults['preparingDownloads'] != None and len(requestResults['preparingDownloads']) > 0:
-                downloadIds = []
-                for label in labels:
-                    requestResultsUpdated = self.downloadRetrieve(label)
-                    downloadUpdate = requestResultsUpdated['available'] + requestResultsUpdated['requested']
-                    download_scenes(downloadUpdate, downloadMeta)
-                    downloadIds += downloadMeta
-                while len(downloadIds) < requestedDownloadsCount:
-                    preparingDownloads = requestedDownloadsCount - len(downloadIds)
-                    logging.info('M2M.retrieveScenes - {} downloads are not available. Waiting 10 seconds...'.format(preparingDownloads))
-                    time.sleep(10)
+            self.downloadMetadata(labels, downloadMeta)
+            expectedDownloadsCount = requestedDownloadsCount - len(requestResults.get('failed') or [])
+            handledIds = set()
+            futures = []
+            with DownloadScheduler() as scheduler:
+                def handle(downloadList):
+                    newDownloads = []
+                    for download in downloadList or []:
+                        idD = str(download['downloadId'])
+                        # requested entries only get a url once they can be downloaded
+                        if idD not in handledIds and download.get('url'):
+                            handledIds.add(idD)
+                            newDownloads.append(download)
+                    if not newDownloads:
+                        return 0
+                    if any('displayId' not in downloadMeta.get(str(d['downloadId']), {}) for d in newDownloads):
+                        self.downloadMetadata(labels, downloadMeta)
+                    futures.extend(download_scenes(newDownloads, downloadMeta, scheduler, acq_directory))
+                    return len(newDownloads)
+
+                handle(requestResults['availableDownloads'])
+                # poll with exponential backoff and jitter, going back to fast polling whenever
+                # new downloads show up; available downloads start while polling continues
+                delay = poll_min_seconds
+                deadline = time.time() + poll_timeout_seconds
+                while len(handledIds) < expectedDownloadsCount:
+                    newDownloadsCount = 0
                     for label in labels:
                         requestResultsUpdated = self.downloadRetrieve(label)
-                        downloadUpdate = requestResultsUpdated['available']
-                        download_scenes(downloadUpdate, downloadMeta)
-                        downloadIds += downloadUpdate
-            else:
-                download_scenes(requestResults['availableDownloads'], downloadMeta)
+                        # like the USGS sample client, some products are only ever listed as requested
+                        downloadUpdate = (requestResultsUpdated['available'] or []) + (requestResultsUpdated['requested'] or [])
+                        newDownloadsCount += handle(downloadUpdate)
+                    preparingDownloads = expectedDownloadsCount - len(handledIds)
+                    if preparingDownloads <= 0:
+                        break
+                    if time.time() > deadline:
+                        logging.warning('M2M.retrieveScenes - {} downloads still not available after {} seconds, giving up on them'.format(preparingDownloads, poll_timeout_seconds))
+                        break
+                    delay = poll_min_seconds if newDownloadsCount else min(2 * delay, poll_max_seconds)
+                    sec = random.uniform(0.5, 1.) * delay
+                    logging.info('M2M.retrieveScenes - {} downloads are not available. Waiting {:.1f} seconds...'.format(preparingDownloads, sec))
+                    time.sleep(sec)
+            for idD in handledIds:
+                local_path = downloadMeta[idD].get('local_path')
+                if not local_path or not available_locally(local_path):
+                    downloadMeta[idD]['error'] = 'download failed'
+            requestedIds = {str(download['downloadId']) for download in (requestResults['availableDownloads'] or []) + (requestResults['preparingDownloads'] or [])}
+            for idD in requestedIds - handledIds:
+                downloadMeta.setdefault(idD, {})['error'] = 'not available'
+            failedDownloadsCount = sum('error' in meta for meta in downloadMeta.values())
+            if failedDownloadsCount:
+                logging.warning('M2M.retrieveScenes - {} of {} downloads failed or were not available'.format(failedDownloadsCount, len(handledIds | requestedIds)))
         else:
             logging.info('M2M.retrieveScenes - No download options found')
         for label in labels:
@@ -256,6 +344,27 @@ def retry_connect(url, json_data, headers={}, max_retries=5, sleep_seconds=2, ti
             time.sleep(sec)
     raise M2MError("Maximum retries exceeded")
 
+def merge_outputs(outputs):
+    """
+    Merge the dictionary outputs of a chunked request: lists are concatenated,
+    dictionaries updated and numbers added. M2M returns empty mappings such as
+    duplicateProducts as [], so empty lists and dictionaries count as absent.
+    """
+    merged = {}
+    for output in outputs:
+        for key, value in output.items():
+            if isinstance(value, (list, dict)) and not value and key in merged:
+                continue
+            if merged.get(key) is None or (isinstance(merged[key], (list, dict)) and not merged[key]):
+                merged[key] = value
+            elif isinstance(value, list):
+                merged[key] = merged[key] + value
+            elif isinstance(value, dict):
+                merged[key] = dict(merged[key], **value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] += value
+    return merged
+
 def apply_filter(elements, key_filters):
     result = []
     if elements != None:
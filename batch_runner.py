@@ -0,0 +1,331 @@
+import os
+import os.path as osp
+import json
+import time
+import socket
+import logging
+import sqlite3
+import argparse
+import threading
+from collections import defaultdict
+
+from api import M2M, M2MError
+from download_utils import prepare_aoi, get_band_datasets, download_band_datasets, organize_band_files
+from raster_utils import create_nbr_rasters, reproject_raster, tile_directory, clip_raster
+
+lease_seconds = 15 * 60
+max_attempts = 3
+idle_sleep_seconds = 30
+
+class TaskError(Exception):
+    """
+    Raised when a task could not produce all of its outputs.
+    """
+    pass
+
+class WorkQueue(object):
+    """
+    Lock-protected work queue kept in a SQLite file on storage shared by all workers.
+
+    Workers claim a task for lease_seconds and renew the lease with heartbeat while they work on it.
+    Tasks whose lease expired (their worker died) are handed out again, up to max_attempts times.
+    The filesystem holding the queue must support POSIX locks for SQLite to be safe across nodes.
+    """
+
+    def __init__(self, path, lease_seconds=lease_seconds, max_attempts=max_attempts):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        with self.transaction() as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS tasks (
+                    key TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    error TEXT
+                )''')
+            db.execute('CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def transaction(self):
+        return Transaction(self.path)
+
+    def set_config(self, config):
+        with self.transaction() as db:
+            db.executemany(
+                'INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)',
+                [(key, json.dumps(value)) for key, value in config.items()]
+            )
+
+    def get_config(self):
+        with self.transaction() as db:
+            return {key: json.loads(value) for key, value in db.execute('SELECT key, value FROM config')}
+
+    def add(self, key, payload):
+        """
+        Add a task, tasks already in the queue are left untouched.
+        """
+        with self.transaction() as db:
+            db.execute('INSERT OR IGNORE INTO tasks (key, payload) VALUES (?, ?)', (key, json.dumps(payload)))
+
+    def claim(self, worker):
+        """
+        Claim the next pending or abandoned task, returns (key, payload) or None if there is nothing to claim.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE tasks SET status = 'failed', error = 'lease expired too many times' "
+                "WHERE status = 'claimed' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            )
+            row = db.execute(
+                "SELECT key, payload FROM tasks "
+                "WHERE status = 'pending' OR (status = 'claimed' AND lease_expires < ?) "
+                "ORDER BY attempts, key LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            key, payload = row
+            db.execute(
+                "UPDATE tasks SET status = 'claimed', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE key = ?",
+                (worker, now + self.lease_seconds, key)
+            )
+        return key, json.loads(payload)
+
+    def heartbeat(self, key, worker):
+        """
+        Renew the lease on a task, returns False if the task is no longer held by this worker.
+        """
+        with self.transaction() as db:
+            cursor = db.execute(
+                "UPDATE tasks SET lease_expires = ? WHERE key = ? AND worker = ? AND status = 'claimed'",
+                (time.time() + self.lease_seconds, key, worker)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, key, worker):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE tasks SET status = 'done', lease_expires = NULL, error = NULL WHERE key = ? AND worker = ?",
+                (key, worker)
+            )
+
+    def fail(self, key, worker, error):
+        with self.transaction() as db:
+            db.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "lease_expires = NULL, error = ? WHERE key = ? AND worker = ? AND status = 'claimed'",
+                (self.max_attempts, error, key, worker)
+            )
+
+    def counts(self):
+        with self.transaction() as db:
+            return dict(db.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status'))
+
+class Transaction(object):
+    """
+    Connection to the queue database holding the write lock (BEGIN IMMEDIATE) until exit.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+        finally:
+            self.db.close()
+
+def shard_key(displayId):
+    """
+    <pathRow>_<acquisition date> of a Landsat file, e.g. LC08_L2SP_042034_20200815_... -> 042034_20200815
+    """
+    parts = displayId.split('_')
+    return f'{parts[2]}_{parts[3]}'
+
+def enqueue(queue_path, m2m, bands, filters, work_directory, aoi_geojson_path=None, crs='EPSG:4326', resolution=None):
+    """
+    Search for band files and add one task per pathRow and date to the queue.
+    """
+    queue = WorkQueue(queue_path)
+    # workers may run on other nodes or from other directories, so paths are stored absolute
+    work_directory = osp.abspath(work_directory)
+    config = {
+        'bands': bands,
+        'work_directory': work_directory,
+        'mask_directory': osp.join(work_directory, 'masks'),
+        'crs': crs,
+        'resolution': resolution,
+        'cutline': None
+    }
+    if aoi_geojson_path:
+        aoi = prepare_aoi(aoi_geojson_path)
+        filters = dict(filters, geoJsonType=aoi['search']['type'], geoJsonCoords=aoi['search']['coordinates'])
+        config['cutline'] = osp.abspath(aoi['cutline'])
+    queue.set_config(config)
+    band_files = get_band_datasets(m2m, bands, filters)
+    shards = defaultdict(lambda: {band: [] for band in bands})
+    for band in bands:
+        for band_file in band_files[band]:
+            shards[shard_key(band_file['displayId'])][band].append(band_file)
+    for key, shard_band_files in shards.items():
+        queue.add(key, shard_band_files)
+    print(f'\nadded {len(shards)} tasks to queue {queue_path}')
+    return queue
+
+def process_task(m2m, key, band_files, config):
+    """
+    Download, compute NBR and reproject the files of one pathRow and date.
+    """
+    work_directory = config['work_directory']
+    data_directory = osp.join(work_directory, 'raster_data')
+    acq_directory = osp.join(work_directory, 'ingest', key)
+    band_filenames, _ = download_band_datasets(m2m, band_files, acq_directory=acq_directory, label=f'get-nbr_{key}')
+    # created up front since several workers share these directories
+    for directory in list(band_filenames) + ['NBR', 'reprojected_NBR']:
+        os.makedirs(osp.join(data_directory, directory), exist_ok=True)
+    organize_band_files(acq_directory, data_directory, band_filenames)
+    # fail the task rather than mark it done with partial output, so the queue retries it
+    missing = [
+        filename for band, filenames in band_filenames.items() for filename in filenames
+        if not osp.exists(osp.join(data_directory, band, filename))
+    ]
+    if missing:
+        raise TaskError('process_task - {} - {} band files are missing: {}'.format(key, len(missing), ', '.join(missing)))
+    bands = list(band_filenames.keys())
+    nbr_directory = create_nbr_rasters(
+        data_directory,
+        band_filenames,
+        aoi_geojson_path=config['cutline'],
+        mask_directory=config['mask_directory'],
+        filenames=band_filenames[bands[0]]
+    )
+    for filename in band_filenames[bands[0]]:
+        nbr_filename = filename[:-6]+'NBR.TIF'
+        nbr_filepath = osp.join(nbr_directory, nbr_filename)
+        if osp.exists(nbr_filepath):
+            reproject_raster(nbr_filepath, osp.join(data_directory, 'reprojected_NBR', nbr_filename), config['crs'], config['resolution'])
+
+def is_auth_error(error):
+    # M2M error codes for missing, invalid or expired API keys start with AUTH
+    return 'AUTH' in str(error)
+
+def run_worker(queue_path, worker_id=None):
+    """
+    Claim and process tasks until the queue has no pending or claimed tasks left.
+    """
+    if worker_id is None:
+        worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    queue = WorkQueue(queue_path)
+    config = queue.get_config()
+    m2m = None
+    while True:
+        task = queue.claim(worker_id)
+        if task is None:
+            counts = queue.counts()
+            if not counts.get('pending') and not counts.get('claimed'):
+                break
+            # other workers hold the remaining tasks, wait in case their leases expire
+            time.sleep(idle_sleep_seconds)
+            continue
+        key, band_files = task
+        logging.info('run_worker - {} - claimed task {}'.format(worker_id, key))
+        stop = threading.Event()
+        def heartbeat():
+            while not stop.wait(queue.lease_seconds / 3):
+                if not queue.heartbeat(key, worker_id):
+                    logging.warning('run_worker - {} - lost lease on task {}'.format(worker_id, key))
+                    return
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            for attempt in range(2):
+                if m2m is None:
+                    m2m = M2M()
+                try:
+                    process_task(m2m, key, band_files, config)
+                    break
+                except M2MError as e:
+                    if not is_auth_error(e):
+                        raise
+                    # API keys expire after about 2 hours, log in again and retry the task once
+                    m2m = None
+                    if attempt:
+                        raise
+                    logging.warning('run_worker - {} - M2M session expired during task {}, logging in again'.format(worker_id, key))
+            queue.complete(key, worker_id)
+            logging.info('run_worker - {} - completed task {}'.format(worker_id, key))
+        except Exception as e:
+            logging.exception('run_worker - {} - task {} failed'.format(worker_id, key))
+            queue.fail(key, worker_id, repr(e))
+        finally:
+            stop.set()
+            heartbeat_thread.join()
+    print(f'worker {worker_id} finished, queue status {queue.counts()}')
+
+def finalize(queue_path):
+    """
+    Tile the reprojected NBR rasters of every task and clip them to the AOI once all tasks are done.
+    """
+    queue = WorkQueue(queue_path)
+    counts = queue.counts()
+    if set(counts) - {'done'}:
+        print(f'tasks are not finished yet, queue status {counts}')
+        return
+    config = queue.get_config()
+    work_directory = config['work_directory']
+    tiled_raster_filepath = tile_directory(osp.join(work_directory, 'raster_data', 'reprojected_NBR'))
+    if config['cutline']:
+        return clip_raster(tiled_raster_filepath, aoi_geojson_path=config['cutline'], mask_directory=config['mask_directory'])
+    return tiled_raster_filepath
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless, sharded NBR batch runner.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    enqueue_parser = subparsers.add_parser('enqueue', help='search scenes and add one task per pathRow and date')
+    enqueue_parser.add_argument('queue')
+    enqueue_parser.add_argument('--work-directory', required=True)
+    enqueue_parser.add_argument('--aoi')
+    enqueue_parser.add_argument('--start-date', required=True)
+    enqueue_parser.add_argument('--end-date', required=True)
+    enqueue_parser.add_argument('--max-cloud-cover', type=int, default=10)
+    enqueue_parser.add_argument('--max-results', type=int, default=10000)
+    enqueue_parser.add_argument('--bands', nargs='+', default=['B5', 'B7'])
+    enqueue_parser.add_argument('--crs', default='EPSG:4326')
+    enqueue_parser.add_argument('--resolution', type=float)
+    work_parser = subparsers.add_parser('work', help='claim and process tasks until the queue is drained')
+    work_parser.add_argument('queue')
+    work_parser.add_argument('--worker-id')
+    finalize_parser = subparsers.add_parser('finalize', help='tile and clip the results once every task is done')
+    finalize_parser.add_argument('queue')
+    status_parser = subparsers.add_parser('status', help='print the number of tasks per status')
+    status_parser.add_argument('queue')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'enqueue':
+        filters = {
+            'startDate': args.start_date,
+            'endDate': args.end_date,
+            'maxCC': args.max_cloud_cover,
+            'maxResults': args.max_results
+        }
+        enqueue(args.queue, M2M(), args.bands, filters, args.work_directory, args.aoi, args.crs, args.resolution)
+    elif args.command == 'work':
+        run_worker(args.queue, args.worker_id)
+    elif args.command == 'finalize':
+        finalize(args.queue)
+    else:
+        print(WorkQueue(args.queue).counts())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import os
+import time
+import threading
+import concurrent.futures
+
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKEND_ENV = 'GET_NBR_BACKEND'
+chunk_rows = 64
+_backend = None
+_threads = os.cpu_count() or 1
+_executor = None
+_executor_lock = threading.Lock()
+
+class BackendError(Exception):
+    """
+    Raised when a compute backend is not available.
+    """
+    pass
+
+def available_backends():
+    backends = ['numpy']
+    if numexpr is not None:
+        backends.append('numexpr')
+    if numba is not None:
+        backends.append('numba')
+    return backends
+
+def set_backend(name=None, threads=None):
+    """
+    Select the backend used by nbr_int16 and quantize_int16.
+
+    :param name: 'numba', 'numexpr' or 'numpy', the first of those that is installed if None,
+        defaults to the GET_NBR_BACKEND environment variable when set
+    :param threads: number of threads to use, all cores if None
+    """
+    global _backend, _threads, _executor
+    if name is None:
+        name = os.environ.get(BACKEND_ENV)
+    if name is None:
+        name = [backend for backend in ['numba', 'numexpr', 'numpy'] if backend in available_backends()][0]
+    if name not in available_backends():
+        raise BackendError(f'backend {name} not one of the available backends {available_backends()}')
+    _backend = name
+    if threads is not None and threads != _threads:
+        _threads = threads
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+                _executor = None
+    if numexpr is not None:
+        numexpr.set_num_threads(_threads)
+    if numba is not None:
+        numba.set_num_threads(min(_threads, numba.config.NUMBA_NUM_THREADS))
+    return _backend
+
+def get_backend():
+    if _backend is None:
+        set_backend()
+    return _backend
+
+def row_chunks(rows):
+    return [(row, min(row+chunk_rows, rows)) for row in range(0, rows, chunk_rows)]
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(max_workers=_threads)
+        return _executor
+
+def run_chunks(kernel, rows):
+    # numpy ufuncs release the GIL, so chunks run in parallel on a shared thread pool,
+    # arrays of one or two chunks are not worth handing off
+    if _threads == 1 or rows < 2 * chunk_rows:
+        for start, stop in row_chunks(rows):
+            kernel(start, stop)
+        return
+    list(get_executor().map(lambda chunk: kernel(*chunk), row_chunks(rows)))
+
+def numexpr_operand(array):
+    # numexpr evaluates in the widest input type, so float32 is upcast to round like the other backends,
+    # small integers are upcast by numexpr itself but wide unsigned ones need a float copy
+    if (array.dtype.kind == 'f' and array.dtype.itemsize < 8) or (array.dtype.kind == 'u' and array.dtype.itemsize >= 4):
+        return array.astype('float64')
+    return array
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _nbr_numba(band1, band2, nodata_value, scale, out):
+        rows, cols = band1.shape
+        for i in numba.prange(rows):
+            for j in range(cols):
+                x = np.float64(band1[i, j])
+                y = np.float64(band2[i, j])
+                value = (x - y) / (x + y) * scale
+                if np.isfinite(value):
+                    out[i, j] = np.int16(np.rint(value))
+                else:
+                    out[i, j] = nodata_value
+
+    @numba.njit(parallel=True, cache=True)
+    def _quantize_numba(array, nodata_value, scale, out):
+        rows, cols = array.shape
+        for i in numba.prange(rows):
+            for j in range(cols):
+                value = np.float64(array[i, j]) * scale
+                if np.isfinite(value):
+                    out[i, j] = np.int16(np.rint(value))
+                else:
+                    out[i, j] = nodata_value
+
+def nbr_int16(band1, band2, nodata_value=-20000, scale=10000):
+    """
+    Fused normalized difference, zero-denominator handling and int16 quantization.
+
+    Equivalent to quantize_int16(compute_nbr(band1, band2)) without the full-size float temporaries:
+    (band1 - band2) / (band1 + band2) * scale rounded to int16, nodata_value where the ratio is not finite.
+
+    :param band1: first band, any numeric dtype
+    :param band2: second band, same shape as band1
+    """
+    backend = get_backend()
+    out = np.empty(band1.shape, dtype='int16')
+    if backend == 'numba':
+        _nbr_numba(band1, band2, nodata_value, float(scale), out)
+        return out
+    def kernel(start, stop):
+        b1 = band1[start:stop]
+        b2 = band2[start:stop]
+        if backend == 'numexpr':
+            b1 = numexpr_operand(b1)
+            b2 = numexpr_operand(b2)
+            value = numexpr.evaluate('(b1 - b2) / (b1 + b2) * scale', local_dict={'b1': b1, 'b2': b2, 'scale': float(scale)})
+        else:
+            b1 = b1.astype('float64')
+            value = b1 - b2
+            b1 += b2
+            with np.errstate(divide='ignore', invalid='ignore'):
+                value /= b1
+            value *= scale
+        finish_chunk(value, nodata_value, out[start:stop])
+    run_chunks(kernel, band1.shape[0])
+    return out
+
+def quantize_int16(array, nodata_value=-20000, scale=10000):
+    """
+    Scale a float array to int16, nodata_value where it is not finite.
+    """
+    backend = get_backend()
+    out = np.empty(array.shape, dtype='int16')
+    if backend == 'numba':
+        _quantize_numba(array, nodata_value, float(scale), out)
+        return out
+    def kernel(start, stop):
+        chunk = array[start:stop]
+        if backend == 'numexpr':
+            value = numexpr.evaluate('chunk * scale', local_dict={'chunk': numexpr_operand(chunk), 'scale': float(scale)})
+        else:
+            value = chunk.astype('float64')
+            value *= scale
+        finish_chunk(value, nodata_value, out[start:stop])
+    run_chunks(kernel, array.shape[0])
+    return out
+
+def finish_chunk(value, nodata_value, out):
+    invalid = ~np.isfinite(value)
+    value[invalid] = nodata_value
+    np.rint(value, out=value)
+    out[...] = value
+
+def benchmark_backends(size=4096, threads=None, repeat=3):
+    """
+    Time nbr_int16 on a synthetic size x size scene for every available backend and thread count,
+    printing throughput and the speedup over single-threaded NumPy.
+    """
+    if threads is None:
+        threads = sorted({1, 2, 4, 8, os.cpu_count() or 1})
+        threads = [n for n in threads if n <= (os.cpu_count() or 1)]
+    rng = np.random.default_rng(0)
+    band1 = rng.integers(0, 30000, (size, size)).astype('uint16')
+    band2 = rng.integers(0, 30000, (size, size)).astype('uint16')
+    band1[:64] = band2[:64] = 0
+    previous = (_backend, _threads)
+    reference = None
+    results = []
+    try:
+        for backend in available_backends():
+            for n in threads:
+                set_backend(backend, n)
+                nbr_int16(band1[:chunk_rows], band2[:chunk_rows]) # warm up (numba compilation)
+                seconds = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    nbr_int16(band1, band2)
+                    seconds.append(time.perf_counter() - start)
+                best = min(seconds)
+                if reference is None:
+                    reference = best
+                results.append((backend, n, best))
+                print(f'{backend:>8} {n:>3} threads: {size*size/best/1e6:8.1f} Mpx/s  speedup {reference/best:5.2f}x  per thread {reference/best/n:5.2f}x')
+    finally:
+        set_backend(*previous)
+    return results
+
+if __name__ == '__main__':
+    benchmark_backends()
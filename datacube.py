@@ -0,0 +1,160 @@
+import os
+import os.path as osp
+import math
+from collections import defaultdict
+
+import numpy as np
+import zarr
+from numcodecs import Blosc
+from osgeo import gdal
+from tqdm import tqdm
+
+from raster_utils import NBR_NODATA
+gdal.UseExceptions()
+
+# 16 dates per chunk, so reading a pixel's history opens one chunk file per 16 dates rather than
+# one per date. the cost is that each append rewrites the partially filled time chunk of every
+# tile it touches and a single date read decompresses 16 dates; lower the time chunk for
+# datacubes that are mostly read one date at a time
+default_chunks = (16, 256, 256)
+
+def acquisition_date(filename):
+    '''
+    acquisition date of a Landsat product from its name, e.g.
+    LC08_L2SP_042034_20200815_20200919_02_T1_SR_NBR.TIF -> 2020-08-15
+    '''
+    date = osp.basename(filename).split('_')[3]
+    return np.datetime64(f'{date[:4]}-{date[4:6]}-{date[6:8]}', 'D')
+
+def get_common_grid(filepaths, crs='EPSG:4326', resolution=None, bounds=None):
+    '''
+    grid (geoTransform, projection, (rows, cols)) in `crs` covering every raster in `filepaths`.
+    `resolution` defaults to the finest input resolution, and the bounds are snapped to
+    multiples of it so grids built from different file sets line up
+    '''
+    extents = []
+    resolutions = []
+    for filepath in filepaths:
+        warped = gdal.Warp('', filepath, format='VRT', dstSRS=crs)
+        x0, dx, _, y0, _, dy = warped.GetGeoTransform()
+        extents.append((x0, y0 + dy*warped.RasterYSize, x0 + dx*warped.RasterXSize, y0))
+        resolutions.append(min(abs(dx), abs(dy)))
+        projection = warped.GetProjection()
+        del warped
+    if resolution is None:
+        resolution = min(resolutions)
+    if bounds is None:
+        bounds = (
+            min(e[0] for e in extents), min(e[1] for e in extents),
+            max(e[2] for e in extents), max(e[3] for e in extents)
+        )
+    min_x = math.floor(bounds[0]/resolution) * resolution
+    min_y = math.floor(bounds[1]/resolution) * resolution
+    max_x = math.ceil(bounds[2]/resolution) * resolution
+    max_y = math.ceil(bounds[3]/resolution) * resolution
+    shape = (int(round((max_y-min_y)/resolution)), int(round((max_x-min_x)/resolution)))
+    geoTransform = (min_x, resolution, 0., max_y, 0., -resolution)
+    return geoTransform, projection, shape
+
+def create_datacube(datacube_path, grid, chunks=default_chunks, compressor=None):
+    geoTransform, projection, (rows, cols) = grid
+    if compressor is None:
+        compressor = Blosc(cname='zstd', clevel=5, shuffle=Blosc.BITSHUFFLE)
+    root = zarr.open_group(datacube_path, mode='w')
+    root.attrs.update({'crs': projection, 'geoTransform': list(geoTransform)})
+    nbr = root.create_dataset(
+        'nbr',
+        shape=(0, rows, cols),
+        chunks=chunks,
+        dtype='int16',
+        fill_value=NBR_NODATA,
+        compressor=compressor,
+        write_empty_chunks=False
+    )
+    # `_ARRAY_DIMENSIONS` lets xarray.open_zarr pick up the dimension names
+    nbr.attrs.update({'_ARRAY_DIMENSIONS': ['time', 'y', 'x'], 'scale_factor': 1e-4})
+    time = root.create_dataset('time', shape=(0,), chunks=(1024,), dtype='M8[D]')
+    time.attrs['_ARRAY_DIMENSIONS'] = ['time']
+    x0, dx, _, y0, _, dy = geoTransform
+    x = root.create_dataset('x', data=x0 + dx*(np.arange(cols)+0.5))
+    x.attrs['_ARRAY_DIMENSIONS'] = ['x']
+    y = root.create_dataset('y', data=y0 + dy*(np.arange(rows)+0.5))
+    y.attrs['_ARRAY_DIMENSIONS'] = ['y']
+    return root
+
+def append_to_datacube(datacube_path, filepaths, date, grid=None, chunks=default_chunks, resampleAlg='nearest'):
+    '''
+    warp the rasters in `filepaths` (all acquired on `date`) onto the datacube grid and
+    append them as a single time step. the datacube is created with `grid` if it does not exist yet.
+    the datacube is append-only, so `date` must not be earlier than the last date already in it
+    '''
+    if osp.exists(datacube_path):
+        root = zarr.open_group(datacube_path, mode='a')
+    else:
+        if grid is None:
+            grid = get_common_grid(filepaths)
+        root = create_datacube(datacube_path, grid, chunks)
+    date = np.datetime64(date, 'D')
+    nbr = root['nbr']
+    time = root['time']
+    dates = time[:]
+    if date in dates:
+        print(f'date {date} already in datacube {datacube_path}')
+        return
+    # an out of order date would make the time coordinate non-monotonic
+    if len(dates) and date < dates[-1]:
+        raise ValueError(f'date {date} is earlier than the last date {dates[-1]} in datacube {datacube_path}, dates must be appended in chronological order')
+    geoTransform = root.attrs['geoTransform']
+    _, rows, cols = nbr.shape
+    x0, dx, _, y0, _, dy = geoTransform
+    warped = gdal.Warp(
+        '',
+        filepaths,
+        format='VRT',
+        dstSRS=root.attrs['crs'],
+        outputBounds=(x0, y0 + dy*rows, x0 + dx*cols, y0),
+        width=cols,
+        height=rows,
+        srcNodata=NBR_NODATA,
+        dstNodata=NBR_NODATA,
+        resampleAlg=resampleAlg
+    )
+    band = warped.GetRasterBand(1)
+    # a previous append may have resized `nbr` and failed before recording its date
+    t = len(time)
+    nbr.resize(t+1, rows, cols)
+    strip_rows = nbr.chunks[1]
+    for y in range(0, rows, strip_rows):
+        height = min(strip_rows, rows-y)
+        nbr[t, y:y+height, :] = band.ReadAsArray(0, y, cols, height)
+    del band
+    del warped
+    time.append(np.array([date]))
+
+def export_datacube(directory, datacube_path=None, crs='EPSG:4326', resolution=None, bounds=None, chunks=default_chunks):
+    '''
+    append every raster in `directory` to a chunked, compressed (time, y, x) zarr datacube,
+    one time step per acquisition date. dates already in the datacube are skipped, and
+    new dates earlier than the last one in it are rejected before anything is appended
+    '''
+    if not datacube_path:
+        base_directory = osp.basename(directory)
+        parent_directory = osp.dirname(directory)
+        datacube_path = osp.join(parent_directory, base_directory+'.zarr')
+    filepaths_by_date = defaultdict(list)
+    for filename in os.listdir(directory):
+        filepaths_by_date[acquisition_date(filename)].append(osp.join(directory, filename))
+    grid = None
+    if osp.exists(datacube_path):
+        dates = zarr.open_group(datacube_path, mode='r')['time'][:]
+        earlier_dates = [date for date in filepaths_by_date if len(dates) and date < dates[-1] and date not in dates]
+        if earlier_dates:
+            raise ValueError(f'dates {sorted(earlier_dates)} are earlier than the last date {dates[-1]} in datacube {datacube_path}, dates must be appended in chronological order')
+    else:
+        filepaths = [filepath for filepaths in filepaths_by_date.values() for filepath in filepaths]
+        grid = get_common_grid(filepaths, crs, resolution, bounds)
+    print(f'appending {len(filepaths_by_date)} dates to datacube {datacube_path} ...')
+    for date in tqdm(sorted(filepaths_by_date)):
+        append_to_datacube(datacube_path, filepaths_by_date[date], date, grid, chunks)
+    print(f'successfully saved datacube to {datacube_path}')
+    return datacube_path
@@ -1,4 +1,4 @@
-from shapely.geometry import  mapping, Polygon, MultiPolygon, LineString, MultiLineString
+from shapely.geometry import  mapping, shape, Polygon, MultiPolygon, LineString, MultiLineString
 from shapely.ops import unary_union, linemerge, polygonize
 
 import pandas as pd
@@ -6,12 +6,19 @@ import geopandas as gpd
 
 import os
 import os.path as osp
+import json
+import hashlib
 
 # get scenes
 bands = ['B5', 'B7']
 scene_dataset = 'landsat_ot_c2_l2' 
 band_dataset = 'landsat_band_files_c2_l2' # raw bands live in a different dataset
 
+# simplification tolerances (degrees, EPSG:4326) for each consumer of the AOI
+search_tolerance = 0.01 # ~1 km, plenty for the M2M spatialFilter
+cutline_tolerance = 0.00027 # ~1 Landsat pixel (30 m)
+_prepared_aois = {}
+
 def get_geojson_boundary(path: str) -> dict:
     '''
     get boundary of a shapefile or geojson, returned as a single geojson feature
@@ -40,6 +47,64 @@ def get_geojson_boundary(path: str) -> dict:
     geojson = mapping(boundary_polygon)
     return geojson
 
+def get_file_hash(path: str) -> str:
+    '''
+    sha256 of a file's contents, used to key cached products derived from it
+    '''
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def prepare_aoi(path: str, search_tolerance=search_tolerance, cutline_tolerance=cutline_tolerance) -> dict:
+    '''
+    build (or load from cache) simplified versions of the boundary of a shapefile or geojson.
+    results are keyed by the hash of the source file and stored next to it as
+    `<name>.<hash>.search.geojson` and `<name>.<hash>.cutline.geojson`, returned as
+        {
+            'hash': <sha256 of the source file>,
+            'search': <geojson geometry for the M2M spatialFilter>,
+            'cutline': <path to a geojson usable as a GDAL cutline>
+        }
+    '''
+    file_hash = get_file_hash(path)
+    key = (file_hash, search_tolerance, cutline_tolerance)
+    if key in _prepared_aois:
+        return _prepared_aois[key]
+    stem = osp.splitext(path)[0]
+    prepared_filepaths = {
+        consumer: f'{stem}.{file_hash[:16]}.{consumer}.geojson'
+        for consumer in ('search', 'cutline')
+    }
+    tolerances = {'search': search_tolerance, 'cutline': cutline_tolerance}
+    geojsons = {}
+    boundary = None
+    for consumer, prepared_filepath in prepared_filepaths.items():
+        if osp.exists(prepared_filepath):
+            with open(prepared_filepath) as f:
+                feature_collection = json.load(f)
+            if feature_collection.get('tolerance') == tolerances[consumer]:
+                geojsons[consumer] = feature_collection['features'][0]['geometry']
+                continue
+        if boundary is None:
+            boundary = shape(get_geojson_boundary(path))
+        geojsons[consumer] = mapping(boundary.simplify(tolerances[consumer], preserve_topology=True))
+        feature_collection = {
+            'type': 'FeatureCollection',
+            'tolerance': tolerances[consumer],
+            'features': [{'type': 'Feature', 'properties': {}, 'geometry': geojsons[consumer]}]
+        }
+        with open(prepared_filepath, 'w') as f:
+            json.dump(feature_collection, f)
+    prepared_aoi = {
+        'hash': file_hash,
+        'search': geojsons['search'],
+        'cutline': prepared_filepaths['cutline']
+    }
+    _prepared_aois[key] = prepared_aoi
+    return prepared_aoi
+
 def get_band_datasets(m2m, bands, params, get_earliest=True):
     params['datasetName'] = scene_dataset
     print(f'searching for scenes ...', end=' ')
@@ -89,8 +154,7 @@ def get_band_datasets(m2m, bands, params, get_earliest=True):
         print(f'    {len(band_downloads)} band files found for {band}')
     return band_files
 
-def download_band_datasets(m2m, band_files: dict)-> tuple:
-    acq_directory = './ingest'
+def download_band_datasets(m2m, band_files: dict, acq_directory='./ingest', label='m2m-api_download')-> tuple:
     print('downloading band files ...')
     filterOptions = {
         'available': lambda x: x,
@@ -99,15 +163,25 @@ def download_band_datasets(m2m, band_files: dict)-> tuple:
     bands = band_files.keys()
     band_filenames = {}
     band_metadata = {}
+    # request every band in one order so the downloader can finish all bands of a pathRow together
+    print(f'    downloading {", ".join(bands)} files ...')
+    band_scenes = {'results': [file for band in bands for file in band_files[band]]}
+    metadata = m2m.retrieveScenes(
+        band_dataset,
+        band_scenes,
+        filterOptions=filterOptions,
+        label=label,
+        acq_directory=acq_directory
+    )
     for band in bands:
-        print(f'    downloading {band} files ...')
-        band_scenes = {'results': band_files[band]}
-        band_metadata[band] = m2m.retrieveScenes(
-            band_dataset,
-            band_scenes, 
-            filterOptions=filterOptions
-        )
+        band_metadata[band] = {
+            downloadId: meta for downloadId, meta in metadata.items()
+            if band in meta.get('displayId', '')
+        }
         band_filenames[band] = [file['displayId'] for file in band_files[band]]
+    failed = [meta.get('displayId', downloadId) for downloadId, meta in metadata.items() if 'error' in meta]
+    if failed:
+        print(f'\n    {len(failed)} band files could not be downloaded: {", ".join(failed)}')
     print(f'\nsuccesfully saved data to directory {acq_directory}')
     return band_filenames, band_metadata
 
@@ -1,5 +1,5 @@
 import concurrent.futures
-import logging, time, subprocess, requests, random, os
+import logging, time, subprocess, requests, urllib3, random, os, heapq, itertools, threading
 from six.moves.urllib import request as urequest
 import os.path as osp
 
@@ -12,6 +12,12 @@ wget_options = ["--quiet", "--read-timeout=1", "--random-wait", "--progress=dot:
 download_sleep_seconds = 3
 
 max_threads = 10
+min_threads = 2
+control_interval_seconds = 2
+bandwidth_burst_seconds = 1
+download_chunk_bytes = 1 << 20
+# cap on aggregate download bandwidth in bytes per second for schedulers created without one, e.g. 50 * 2**20
+bandwidth_limit_bytes = None
 
 class DownloadError(Exception):
     """
@@ -19,7 +25,7 @@ class DownloadError(Exception):
     """
     pass
 
-def download_url(url, local_path, max_retries=total_max_retries, sleep_seconds=sleep_seconds):
+def download_url(url, local_path, max_retries=total_max_retries, sleep_seconds=sleep_seconds, scheduler=None):
     """
     Download a remote URL to the location local_path with retries.
 
@@ -31,23 +37,28 @@ def download_url(url, local_path, max_retries=total_max_retries, sleep_seconds=s
     :param local_path: the path to the local file
     :param max_retries: how many times we may retry to download the file
     :param sleep_seconds: sleep seconds between retries
+    :param scheduler: optional DownloadScheduler used to throttle bandwidth and report throughput and errors
     """
     dname = osp.basename(local_path)
     logging.info('download_url - {} - downloading {} as {}'.format(dname, url, local_path))
-    sec = random.random() * download_sleep_seconds
-    time.sleep(sec)
+    if scheduler is None:
+        sec = random.random() * download_sleep_seconds
+        time.sleep(sec)
 
     try:
         r = requests.get(url, stream=True)
+        r.raise_for_status()
         content_size = int(r.headers.get('content-length', 0))
         if content_size == 0:
             logging.error('download_url - content size is equal to 0')
             raise DownloadError('download_url - content size is equal to 0')
     except Exception as e:
+        if scheduler is not None:
+            scheduler.record_error()
         if max_retries > 0:
             logging.info('download_url - {} - trying again with {} available retries'.format(dname, max_retries))
             time.sleep(sleep_seconds)
-            download_url(url, local_path, max_retries = max_retries - 1, sleep_seconds=sleep_seconds)
+            return download_url(url, local_path, max_retries=max_retries-1, sleep_seconds=sleep_seconds, scheduler=scheduler)
         logging.error('download_url - {} - no more retries available'.format(dname))
         raise DownloadError('download_url - {} - failed to find file {}'.format(dname, url))
 
@@ -60,16 +71,27 @@ def download_url(url, local_path, max_retries=total_max_retries, sleep_seconds=s
     logging.info(' '.join(command))
     subprocess.call(' '.join(command),shell=True)
     '''
-    with open(ensure_dir(local_path), 'wb') as f:
-        f.write(r.raw.read())
+    try:
+        with open(ensure_dir(local_path), 'wb') as f:
+            for chunk in r.raw.stream(download_chunk_bytes, decode_content=False):
+                if scheduler is not None:
+                    scheduler.throttle(len(chunk))
+                f.write(chunk)
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError):
+        # r.raw raises urllib3 errors (e.g. ProtocolError on a short read), the size check below retries
+        logging.warning('download_url - {} - connection lost during download'.format(dname))
+    finally:
+        r.close()
 
     file_size = osp.getsize(local_path)
     logging.info('download_url - {} - local file size {} remote content size {}'.format(dname, file_size, content_size))
     if int(file_size) != int(content_size) and int(content_size) > 0:
         logging.warning('download_url - {} - wrong file size, trying again, retries available {}'.format(dname, max_retries))
+        if scheduler is not None:
+            scheduler.record_error()
         if max_retries > 0:
             time.sleep(sleep_seconds)
-            download_url(url, local_path, content_size, max_retries = max_retries-1, sleep_seconds=sleep_seconds)
+            return download_url(url, local_path, max_retries=max_retries-1, sleep_seconds=sleep_seconds, scheduler=scheduler)
         logging.error('download_url - {} - deleting local file, no more retries available'.format(dname))
         os.remove(local_path)
         raise DownloadError('download_url - {} - failed to download file {}'.format(dname, url))
@@ -78,32 +100,214 @@ def download_url(url, local_path, max_retries=total_max_retries, sleep_seconds=s
     open(ensure_dir(info_path), 'w').write(str(content_size))
     logging.info('download_url - {} - success download'.format(dname))
 
-def download_scenes(downloads, downloadMeta):
+def download_priority(displayId):
+    """
+    Priority key grouping the files of one scene, so that all bands of a pathRow finish together.
+
+    :param displayId: Landsat display id, e.g. LC08_L2SP_042034_20200815_20200919_02_T1_SR_B5
+    """
+    parts = displayId.split('_')
+    if len(parts) >= 4:
+        return (parts[2], parts[3], displayId)
+    return (displayId,)
+
+class DownloadScheduler(object):
+    """
+    Download files on a worker pool whose concurrency is tuned AIMD style.
+
+    Every control interval the aggregate throughput is measured. Concurrency is halved when
+    downloads failed during the interval, increased by one while more files are waiting and the
+    previous increase paid off, and the last increase is reverted when it made throughput drop.
+    Queued files are started in priority order and an optional global bandwidth cap is
+    shared by all workers.
+
+    :param max_threads: upper bound on concurrent downloads
+    :param min_threads: lower bound on concurrent downloads
+    :param bandwidth_limit: optional cap on aggregate bandwidth in bytes per second, bandwidth_limit_bytes if None
+    :param control_interval: seconds between concurrency adjustments and throughput reports
+    """
+
+    def __init__(self, max_threads=max_threads, min_threads=min_threads, bandwidth_limit=None, control_interval=control_interval_seconds):
+        self.max_threads = max_threads
+        self.min_threads = min(min_threads, max_threads)
+        self.limit = self.min_threads
+        self.bandwidth_limit = bandwidth_limit if bandwidth_limit is not None else bandwidth_limit_bytes
+        self.control_interval = control_interval
+        self.condition = threading.Condition()
+        self.queue = []
+        self.counter = itertools.count()
+        self.active = 0
+        self.pending = 0
+        self.closed = False
+        self.bytes = 0
+        self.errors = 0
+        self.bandwidth_time = time.time()
+        self.start_time = time.time()
+        self.interval_bytes = 0
+        self.interval_errors = 0
+        self.last_throughput = None
+        self.last_increase = False
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(max_threads)]
+        for worker in self.workers:
+            worker.start()
+        self.controller = threading.Thread(target=self.control, daemon=True)
+        self.controller.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.join()
+        self.close()
+
+    def submit(self, url, local_path, priority=()):
+        """
+        Queue a file for download and return a concurrent.futures.Future for it.
+        """
+        future = concurrent.futures.Future()
+        with self.condition:
+            if self.closed:
+                raise DownloadError('DownloadScheduler - scheduler is closed')
+            heapq.heappush(self.queue, (priority, next(self.counter), url, local_path, future))
+            self.pending += 1
+            self.condition.notify_all()
+        return future
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.closed and not (self.queue and self.active < self.limit):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                _, _, url, local_path, future = heapq.heappop(self.queue)
+                self.active += 1
+            try:
+                download_url(url, local_path, scheduler=self)
+                future.set_result(local_path)
+            except Exception as e:
+                logging.error('DownloadScheduler - {} - {}'.format(osp.basename(local_path), e))
+                future.set_exception(e)
+            finally:
+                with self.condition:
+                    self.active -= 1
+                    self.pending -= 1
+                    self.condition.notify_all()
+
+    def throttle(self, nbytes):
+        """
+        Account for nbytes received, sleeping as needed to respect the bandwidth limit.
+        """
+        with self.condition:
+            self.bytes += nbytes
+            self.interval_bytes += nbytes
+            if not self.bandwidth_limit:
+                return
+            now = time.time()
+            # allow up to bandwidth_burst_seconds of credit to build up while idle
+            self.bandwidth_time = max(self.bandwidth_time, now - bandwidth_burst_seconds) + nbytes / self.bandwidth_limit
+            delay = self.bandwidth_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def record_error(self):
+        with self.condition:
+            self.errors += 1
+            self.interval_errors += 1
+
+    def throughput(self):
+        """
+        Average aggregate throughput in bytes per second since the scheduler started.
+        """
+        return self.bytes / max(time.time() - self.start_time, 1e-9)
+
+    def control(self):
+        last_time = time.time()
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed, timeout=self.control_interval)
+                if self.closed:
+                    return
+                now = time.time()
+                throughput = self.interval_bytes / max(now - last_time, 1e-9)
+                errors = self.interval_errors
+                last_time = now
+                self.interval_bytes = 0
+                self.interval_errors = 0
+                previous_limit = self.limit
+                if errors:
+                    self.limit = max(self.min_threads, self.limit // 2)
+                    self.last_increase = False
+                elif self.last_increase and self.last_throughput and throughput < 0.9 * self.last_throughput:
+                    self.limit = max(self.min_threads, self.limit - 1)
+                    self.last_increase = False
+                elif self.last_increase and self.last_throughput and throughput < 1.05 * self.last_throughput:
+                    # the last increase did not pay off (e.g. bandwidth capped), hold for an interval before probing again
+                    self.last_increase = False
+                elif self.queue and self.active >= self.limit and self.limit < self.max_threads:
+                    self.limit += 1
+                    self.last_increase = True
+                else:
+                    self.last_increase = False
+                self.last_throughput = throughput
+                if self.limit != previous_limit:
+                    self.condition.notify_all()
+                if self.active or self.queue:
+                    logging.info('DownloadScheduler - {:.2f} MB/s, {} active of {} threads, {} queued, {} errors'.format(
+                        throughput / 2**20, self.active, self.limit, len(self.queue), errors))
+
+    def join(self):
+        """
+        Wait until every submitted file has finished downloading.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending == 0)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+        self.controller.join()
+        logging.info('DownloadScheduler - downloaded {:.1f} MB at {:.2f} MB/s'.format(self.bytes / 2**20, self.throughput() / 2**20))
+
+def download_scenes(downloads, downloadMeta, scheduler=None, acq_directory=None):
     """
     Download all scenes using multithreading.
 
     :param downloads: list of downloadable scenes
     :param downloadMeta: dictionary with metadata from all scenes
+    :param scheduler: optional DownloadScheduler to queue the downloads on without waiting for them,
+        a scheduler is created and waited on if None
+    :param acq_directory: directory to download to, ACQ_PATH if None
     """
+    if acq_directory is None:
+        acq_directory = ACQ_PATH
     logging.info('download_scenes - downloading {} scenes'.format(len(downloads)))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-        futures = []
-        for download in downloads:
-            idD = str(download['downloadId'])
-            displayId = downloadMeta[idD]['displayId']
-            url = download['url']
-            local_path = osp.join(ACQ_PATH, displayId+'.tar')
-            if available_locally(local_path):
-                logging.info('downloadScenes - file {} is locally available'.format(local_path))
-            else:
-                future = executor.submit(download_url, url, local_path)
-                futures.append(future)
-            downloadMeta[idD].update({'url': url, 'local_path': local_path})
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = DownloadScheduler()
+    futures = []
+    for download in downloads:
+        idD = str(download['downloadId'])
+        displayId = downloadMeta[idD]['displayId']
+        url = download['url']
+        local_path = osp.join(acq_directory, displayId+'.tar')
+        if available_locally(local_path):
+            logging.info('downloadScenes - file {} is locally available'.format(local_path))
+        else:
+            future = scheduler.submit(url, local_path, priority=download_priority(displayId))
+            futures.append(future)
+        downloadMeta[idD].update({'url': url, 'local_path': local_path})
+    if own_scheduler:
         finished = 0
         for future in concurrent.futures.as_completed(futures):
             finished += 1
             logging.info('download_scenes - download finished by {}/{} scenes'.format(finished,len(futures)))
-    logging.info('download_scenes - all download scenes finished')
+        scheduler.close()
+        logging.info('download_scenes - all download scenes finished')
+    return futures
 
 def ensure_dir(path):
     """
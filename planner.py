@@ -0,0 +1,196 @@
+import os
+import os.path as osp
+import json
+import time
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import requests
+from osgeo import gdal, osr
+
+from compute_backend import chunk_rows, nbr_int16
+from raster_utils import NBR_NODATA, array_to_raster, reproject_raster, tile_directory, apply_cutline_mask
+gdal.UseExceptions()
+
+CALIBRATION_PATH = '~/.config/get_nbr/calibration.json'
+landsat_scene_pixels = 7900 * 7800
+# size of each stage's output relative to one band file of the same scene,
+# the tiled and clipped stages are relative to the reprojected total.
+# defaults for calibrations without measured ratios
+stage_size_ratios = {
+    'nbr': 1.0,
+    'reprojected': 1.3,
+    'tiled': 0.85,
+}
+stages = ['ingest', 'nbr', 'reprojected', 'tiled', 'clipped']
+
+class PlanError(Exception):
+    """
+    Raised when a planned job exceeds its limits.
+    """
+    pass
+
+def calibrate(calibration_path=CALIBRATION_PATH, size=2048, download_url=None, download_bytes=64 * 2**20):
+    """
+    Measure processing throughput of this machine on a synthetic scene and save it.
+
+    :param calibration_path: where to save the results as json
+    :param size: side in pixels of the synthetic scene
+    :param download_url: optional URL whose first download_bytes are fetched to measure download throughput
+    :param download_bytes: how many bytes of download_url to fetch
+    :return: dictionary of seconds per pixel and output size ratio for each processing stage and download bytes per second
+    """
+    pixels = size * size
+    calibration = {}
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        band1 = rng.integers(7000, 30000, (size, size)).astype('uint16')
+        band2 = rng.integers(7000, 30000, (size, size)).astype('uint16')
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(32611)
+        geoTransform = (300000., 30., 0., 4200000., 0., -30.)
+        # written like the USGS band files, to measure the size of every stage's output against it
+        band_filepath = osp.join(directory, 'LC08_L2SP_042034_20200815_20200919_02_T1_SR_B5.TIF')
+        band_raster = gdal.GetDriverByName('GTiff').Create(band_filepath, size, size, 1, gdal.GDT_UInt16, options=['COMPRESS=DEFLATE'])
+        band_raster.SetGeoTransform(geoTransform)
+        band_raster.SetProjection(srs.ExportToWkt())
+        band_raster.GetRasterBand(1).WriteArray(band1)
+        del band_raster
+        band_bytes = osp.getsize(band_filepath)
+        nbr_filepath = osp.join(directory, 'LC08_L2SP_042034_20200815_20200919_02_T1_SR_NBR.TIF')
+        nbr_int16(band1[:chunk_rows], band2[:chunk_rows], NBR_NODATA) # warm up (numba compilation)
+        start = time.perf_counter()
+        array_to_raster(nbr_int16(band1, band2, NBR_NODATA), geoTransform, srs.ExportToWkt(), nbr_filepath, resample=False, nodata_value=NBR_NODATA, sparse=True)
+        calibration['nbr_seconds_per_pixel'] = (time.perf_counter() - start) / pixels
+
+        reprojected_directory = osp.join(directory, 'reprojected')
+        os.makedirs(reprojected_directory)
+        reprojected_filepath = osp.join(reprojected_directory, osp.basename(nbr_filepath))
+        start = time.perf_counter()
+        reproject_raster(nbr_filepath, reprojected_filepath)
+        calibration['reproject_seconds_per_pixel'] = (time.perf_counter() - start) / pixels
+
+        tiled_filepath = osp.join(directory, 'tiled.TIF')
+        start = time.perf_counter()
+        tile_directory(reprojected_directory, tiled_filepath)
+        calibration['tile_seconds_per_pixel'] = (time.perf_counter() - start) / pixels
+        # the tiled ratio depends on the overlap between the scenes of a job, which one scene can not measure
+        calibration['stage_size_ratios'] = {
+            'nbr': osp.getsize(nbr_filepath) / band_bytes,
+            'reprojected': osp.getsize(reprojected_filepath) / band_bytes,
+        }
+
+        tiled_raster = gdal.Open(tiled_filepath)
+        rows, cols = tiled_raster.RasterYSize, tiled_raster.RasterXSize
+        del tiled_raster
+        packed_mask = np.packbits(np.ones((rows, cols), dtype=bool), axis=1)
+        start = time.perf_counter()
+        apply_cutline_mask(tiled_filepath, osp.join(directory, 'clipped.TIF'), packed_mask, (0, 0, cols, rows), NBR_NODATA)
+        calibration['clip_seconds_per_pixel'] = (time.perf_counter() - start) / (rows * cols)
+
+    if download_url:
+        received = 0
+        start = time.perf_counter()
+        with requests.get(download_url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=2**20):
+                received += len(chunk)
+                if received >= download_bytes:
+                    break
+        calibration['download_bytes_per_second'] = received / (time.perf_counter() - start)
+
+    calibration_path = Path(osp.expandvars(calibration_path)).expanduser()
+    previous = load_calibration(calibration_path) or {}
+    previous.update(calibration)
+    calibration_path.parent.mkdir(parents=True, exist_ok=True)
+    json.dump(previous, open(calibration_path, 'w'), indent=4)
+    return previous
+
+def load_calibration(calibration_path=CALIBRATION_PATH):
+    calibration_path = Path(osp.expandvars(calibration_path)).expanduser()
+    if not calibration_path.exists():
+        return None
+    return json.load(open(calibration_path))
+
+def plan_job(band_files, calibration=None, aoi_fraction=1.0, workers=1, download_bytes_per_second=None):
+    """
+    Estimate transfer, disk footprint per stage and runtime of a job from the output of get_band_datasets.
+
+    :param band_files: dictionary of band file records from get_band_datasets
+    :param calibration: results of calibrate, loaded from CALIBRATION_PATH (or measured) if None
+    :param aoi_fraction: fraction of the tiled mosaic kept after clipping
+    :param workers: number of parallel workers for the processing stages
+    :param download_bytes_per_second: download throughput, taken from the calibration if None
+    """
+    if calibration is None:
+        calibration = load_calibration()
+        if calibration is None:
+            print('no calibration found, running calibration benchmark ...')
+            calibration = calibrate()
+    if download_bytes_per_second is None:
+        download_bytes_per_second = calibration.get('download_bytes_per_second')
+    band_sizes = [band_file.get('filesize') or 0 for files in band_files.values() for band_file in files]
+    scenes = {tuple(band_file['displayId'].split('_')[2:4]) for files in band_files.values() for band_file in files}
+    transfer_bytes = sum(band_sizes)
+    band_file_bytes = transfer_bytes / max(len(band_sizes), 1)
+    scene_count = len(scenes)
+    size_ratios = dict(stage_size_ratios, **calibration.get('stage_size_ratios', {}))
+
+    disk_bytes = {'ingest': transfer_bytes}
+    disk_bytes['nbr'] = scene_count * band_file_bytes * size_ratios['nbr']
+    disk_bytes['reprojected'] = scene_count * band_file_bytes * size_ratios['reprojected']
+    disk_bytes['tiled'] = disk_bytes['reprojected'] * size_ratios['tiled']
+    disk_bytes['clipped'] = disk_bytes['tiled'] * aoi_fraction
+
+    scene_pixels = scene_count * landsat_scene_pixels
+    tiled_pixels = scene_pixels * size_ratios['reprojected'] * size_ratios['tiled']
+    runtime_seconds = {
+        'download': transfer_bytes / download_bytes_per_second if download_bytes_per_second else None,
+        'nbr': scene_pixels * calibration['nbr_seconds_per_pixel'] / workers,
+        'reproject': scene_pixels * calibration['reproject_seconds_per_pixel'] / workers,
+        'tile': tiled_pixels * calibration['tile_seconds_per_pixel'],
+        'clip': tiled_pixels * aoi_fraction * calibration['clip_seconds_per_pixel'],
+    }
+    return {
+        'scenes': scene_count,
+        'files': len(band_sizes),
+        'transfer_bytes': transfer_bytes,
+        'disk_bytes': disk_bytes,
+        # every stage's output is kept on disk
+        'total_disk_bytes': sum(disk_bytes.values()),
+        'runtime_seconds': runtime_seconds,
+        'total_runtime_seconds': sum(seconds for seconds in runtime_seconds.values() if seconds is not None),
+    }
+
+def check_plan(plan, max_transfer_bytes=None, max_disk_bytes=None, max_runtime_seconds=None):
+    """
+    Raise PlanError if a plan from plan_job exceeds any of the given limits,
+    or if a runtime limit is given but the download runtime is unknown.
+    """
+    if max_runtime_seconds is not None and plan['transfer_bytes'] and plan['runtime_seconds']['download'] is None:
+        raise PlanError('download runtime unknown, measure it with calibrate(download_url=...) or pass download_bytes_per_second to plan_job')
+    limits = [
+        ('transfer', plan['transfer_bytes'], max_transfer_bytes),
+        ('disk', plan['total_disk_bytes'], max_disk_bytes),
+        ('runtime', plan['total_runtime_seconds'], max_runtime_seconds),
+    ]
+    for name, value, limit in limits:
+        if limit is not None and value > limit:
+            raise PlanError('{} estimate {:.4g} exceeds limit {:.4g}'.format(name, value, limit))
+
+def print_plan(plan):
+    gb = 2**30
+    print(f"{plan['scenes']} scenes - {plan['files']} band files")
+    print(f"\ntransfer: {plan['transfer_bytes']/gb:.2f} GB")
+    print('\ndisk footprint:')
+    for stage in stages:
+        print(f"    {stage}: {plan['disk_bytes'][stage]/gb:.2f} GB")
+    print(f"    total: {plan['total_disk_bytes']/gb:.2f} GB")
+    print('\nruntime:')
+    for stage, seconds in plan['runtime_seconds'].items():
+        if seconds is None:
+            print(f'    {stage}: unknown (no download throughput measured)')
+        else:
+            print(f'    {stage}: {seconds/60:.1f} min')
+    print(f"    total: {plan['total_runtime_seconds']/3600:.2f} h")
@@ -1,21 +1,40 @@
 import os
 import os.path as osp
+import json
+import hashlib
+import concurrent.futures
 
 import numpy as np
 from osgeo import gdal
 from tqdm import tqdm
 from matplotlib.pyplot import figure, imshow, colorbar, show
+
+from compute_backend import nbr_int16, quantize_int16
 gdal.UseExceptions()
 
-def array_to_raster(array, geoTransform, projection, filename, resample=True):
+NBR_NODATA = -20000 # this is the standard for USGS NBR (-2 * 10000)
+
+def quantize_nbr(array):
+    return quantize_int16(array, NBR_NODATA, 10000)
+
+def array_to_raster(array, geoTransform, projection, filename, resample=True, nodata_value=None, sparse=False, block_size=256):
+    '''
+    write `array` to a GTiff. with `nodata_value` the band's nodata is set explicitly, and with
+    `sparse` the file is tiled with SPARSE_OK and blocks containing only nodata are never written
+    '''
     if resample:
-        np.nan_to_num(array, copy=False, nan=-2, posinf=-2, neginf=-2)
-        array = np.round(array * 10000).astype('int16')
+        array = quantize_nbr(array)
+        dtype = gdal.GDT_Int16
+    elif array.dtype == np.int16:
+        # already quantized, e.g. by `nbr_int16`
         dtype = gdal.GDT_Int16
     else:
         dtype = gdal.GDT_Float32
     pixels_x = array.shape[1]
     pixels_y = array.shape[0]
+    options = ['COMPRESS=ZSTD']
+    if sparse:
+        options += ['TILED=YES', 'SPARSE_OK=TRUE', f'BLOCKXSIZE={block_size}', f'BLOCKYSIZE={block_size}']
     driver = gdal.GetDriverByName('GTiff')
     dataset = driver.Create(
         filename,
@@ -23,10 +42,25 @@ def array_to_raster(array, geoTransform, projection, filename, resample=True):
         pixels_y,
         1,
         dtype,
-        options=['COMPRESS=ZSTD'])
+        options=options)
     dataset.SetGeoTransform(geoTransform)
     dataset.SetProjection(projection)
-    dataset.GetRasterBand(1).WriteArray(array)
+    band = dataset.GetRasterBand(1)
+    if nodata_value is not None:
+        band.SetNoDataValue(nodata_value)
+    if sparse and nodata_value is not None:
+        for y in range(0, pixels_y, block_size):
+            for x in range(0, pixels_x, block_size):
+                block = array[y:y+block_size, x:x+block_size]
+                if np.isnan(nodata_value):
+                    empty = np.isnan(block).all()
+                else:
+                    empty = (block == nodata_value).all()
+                if not empty:
+                    band.WriteArray(block, x, y)
+    else:
+        band.WriteArray(array)
+    del band
     dataset.FlushCache() 
     del dataset
 
@@ -37,9 +71,15 @@ def compute_nbr(band1, band2):
     nbr = num / denom
     return nbr
 
-def create_nbr_raster(band1_filepath, band2_filepath, nbr_filepath):
+def create_nbr_raster(band1_filepath, band2_filepath, nbr_filepath, aoi_geojson_path=None, mask_directory=None):
     if osp.exists(nbr_filepath):
         print(f'file {nbr_filepath} already exists')
+    if aoi_geojson_path:
+        if not mask_directory:
+            # beside the NBR directory rather than in it, which is data_directory/masks for create_nbr_rasters
+            mask_directory = osp.join(osp.dirname(osp.dirname(osp.abspath(nbr_filepath))), 'masks')
+        create_sparse_nbr_raster(band1_filepath, band2_filepath, nbr_filepath, aoi_geojson_path, mask_directory)
+        return
     ## open B5, B7, and get data
     img =  gdal.Open(band1_filepath)
     band1_data = np.array(img.GetRasterBand(1).ReadAsArray())
@@ -49,14 +89,63 @@ def create_nbr_raster(band1_filepath, band2_filepath, nbr_filepath):
     img =  gdal.Open(band2_filepath)
     band2_data = np.array(img.GetRasterBand(1).ReadAsArray())
     del img
-    # compute NBR and manage memory
-    nbr_data = compute_nbr(band1_data.astype('float'), band2_data.astype('float'))
+    # compute and quantize NBR in one pass and manage memory
+    nbr_data = nbr_int16(band1_data, band2_data, NBR_NODATA, 10000)
     del band1_data
     del band2_data
     # write to file
-    array_to_raster(nbr_data, geoTransform, crs, nbr_filepath)
+    array_to_raster(nbr_data, geoTransform, crs, nbr_filepath, resample=False, nodata_value=NBR_NODATA, sparse=True)
 
-def create_nbr_rasters(data_directory, band_filenames):
+def create_sparse_nbr_raster(band1_filepath, band2_filepath, nbr_filepath, aoi_geojson_path, mask_directory):
+    '''
+    compute NBR only for the blocks of the scene that intersect the AOI.
+    blocks outside the AOI are never read and are left unwritten in a SPARSE_OK output,
+    so they read back as nodata
+    '''
+    band1_raster = gdal.Open(band1_filepath)
+    band2_raster = gdal.Open(band2_filepath)
+    band1 = band1_raster.GetRasterBand(1)
+    band2 = band2_raster.GetRasterBand(1)
+    geoTransform = band1_raster.GetGeoTransform()
+    crs = band1_raster.GetProjection()
+    cols, rows = band1_raster.RasterXSize, band1_raster.RasterYSize
+    packed_mask, window = get_cutline_mask(aoi_geojson_path, geoTransform, crs, (rows, cols), mask_directory)
+    # follow the input tiling so every block is decoded at most once
+    block_xsize, block_ysize = band1.GetBlockSize()
+    if block_xsize % 16 or block_ysize % 16 or block_xsize >= cols:
+        block_xsize, block_ysize = 256, 256
+    driver = gdal.GetDriverByName('GTiff')
+    nbr_raster = driver.Create(
+        nbr_filepath,
+        cols,
+        rows,
+        1,
+        gdal.GDT_Int16,
+        options=[
+            'COMPRESS=ZSTD', 'TILED=YES', 'SPARSE_OK=TRUE',
+            f'BLOCKXSIZE={block_xsize}', f'BLOCKYSIZE={block_ysize}'
+        ])
+    nbr_raster.SetGeoTransform(geoTransform)
+    nbr_raster.SetProjection(crs)
+    nbr_band = nbr_raster.GetRasterBand(1)
+    nbr_band.SetNoDataValue(NBR_NODATA)
+    col_off, row_off, xsize, ysize = window
+    first_block_col, first_block_row = col_off // block_xsize, row_off // block_ysize
+    for y in range(first_block_row*block_ysize, row_off+ysize, block_ysize):
+        height = min(block_ysize, rows-y)
+        for x in range(first_block_col*block_xsize, col_off+xsize, block_xsize):
+            width = min(block_xsize, cols-x)
+            if not unpack_mask_window(packed_mask, x, y, width, height).any():
+                continue
+            band1_data = band1.ReadAsArray(x, y, width, height)
+            band2_data = band2.ReadAsArray(x, y, width, height)
+            nbr_band.WriteArray(nbr_int16(band1_data, band2_data, NBR_NODATA, 10000), x, y)
+    nbr_raster.FlushCache()
+    del nbr_raster
+    del band1_raster
+    del band2_raster
+
+def create_nbr_rasters(data_directory, band_filenames, aoi_geojson_path=None, mask_directory=None, filenames=None):
     nbr = 'NBR'
     nbr_directory = osp.join(data_directory, nbr)
     if osp.exists(nbr_directory):
@@ -64,6 +153,8 @@ def create_nbr_rasters(data_directory, band_filenames):
     else:
         os.makedirs(nbr_directory)
         print(f'successfully created directory {nbr_directory}')
+    if aoi_geojson_path and not mask_directory:
+        mask_directory = osp.join(data_directory, 'masks')
     bands = list(band_filenames.keys())
 
     for band in bands:
@@ -71,8 +162,10 @@ def create_nbr_rasters(data_directory, band_filenames):
             print(f'\ndirectory {osp.join(data_directory, band)} does not exist')
             return
         
+    if filenames is None:
+        filenames = os.listdir(osp.join(data_directory, bands[0]))
     print(f'\ncomputing NBR...')
-    for full_filename in tqdm(os.listdir(osp.join(data_directory, bands[0]))):
+    for full_filename in tqdm(filenames):
         file_stem = full_filename[:-6]+'{0}.TIF' 
         nbr_filename = file_stem.format('NBR')
         nbr_filepath = osp.join(nbr_directory, nbr_filename)
@@ -83,11 +176,15 @@ def create_nbr_rasters(data_directory, band_filenames):
             osp.join(data_directory, band, file_stem.format(band))
             for band in bands
         ]
-        create_nbr_raster(*band_filepaths, nbr_filepath)
+        missing_filepaths = [filepath for filepath in band_filepaths if not osp.exists(filepath)]
+        if missing_filepaths:
+            print(f'files {missing_filepaths} do not exist')
+            continue
+        create_nbr_raster(*band_filepaths, nbr_filepath, aoi_geojson_path, mask_directory)
     print(f'\nNBR files successfully written to {nbr_directory}')
     return nbr_directory
 
-def reproject_raster(input_filepath, output_filepath=None, crs='EPSG:4326'):
+def reproject_raster(input_filepath, output_filepath=None, crs='EPSG:4326', resolution=None):
     if not output_filepath:
         input_directory = osp.dirname(input_filepath)
         input_filename = osp.basename(input_filepath)
@@ -99,19 +196,24 @@ def reproject_raster(input_filepath, output_filepath=None, crs='EPSG:4326'):
     band = input_raster.GetRasterBand(1)
     nodata_value = band.GetNoDataValue()
     if nodata_value is None:
-        nodata_value = -20000 # this is the standard for USGS NBR
+        nodata_value = NBR_NODATA
     del input_raster
+    grid_options = {}
+    if resolution:
+        # snap to multiples of `resolution` so every output shares one pixel grid
+        grid_options = {'xRes': resolution, 'yRes': resolution, 'targetAlignedPixels': True}
     gdal.Warp(
         output_filepath,
         input_filepath, 
         dstSRS=crs, 
         dstNodata = nodata_value, 
         srcNodata = nodata_value, 
-        options=['-co', 'COMPRESS=ZSTD']
+        options=['-co', 'COMPRESS=ZSTD'],
+        **grid_options
     )
     return output_filepath
 
-def reproject_directory(directory, reprojection_directory=None, crs='EPSG:4326'):
+def reproject_directory(directory, reprojection_directory=None, crs='EPSG:4326', resolution=None, max_workers=1):
     if not reprojection_directory:
         parent_directory = osp.dirname(directory)
         directory_name = osp.basename(directory)
@@ -124,13 +226,46 @@ def reproject_directory(directory, reprojection_directory=None, crs='EPSG:4326')
         print(f'successfully created directory {reprojection_directory}')
     # reproject rasters
     print(f'\nreprojecting files in {directory} ...')
-    for filename in tqdm(os.listdir(directory)):
-        input_filepath = osp.join(directory, filename)
-        output_filepath = osp.join(reprojection_directory, filename)
-        reproject_raster(input_filepath, output_filepath, crs)
+    filenames = os.listdir(directory)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                reproject_raster,
+                osp.join(directory, filename),
+                osp.join(reprojection_directory, filename),
+                crs,
+                resolution
+            )
+            for filename in filenames
+        ]
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            future.result()
     print(f'\nsuccesfully projected all raster files in {directory} to {crs}\nreprojected files have been saved to {reprojection_directory}')
     return reprojection_directory
 
+def is_grid_aligned(filepaths, tolerance=1e-6):
+    '''
+    whether all rasters share a projection and resolution and their origins lie on the same pixel grid
+    '''
+    grid = None
+    for filepath in filepaths:
+        raster = gdal.Open(filepath)
+        projection = raster.GetProjection()
+        x0, dx, rx, y0, ry, dy = raster.GetGeoTransform()
+        del raster
+        if rx or ry:
+            return False
+        if grid is None:
+            grid = (projection, x0, dx, y0, dy)
+            continue
+        if projection != grid[0] or abs(dx-grid[2]) > tolerance*abs(dx) or abs(dy-grid[4]) > tolerance*abs(dy):
+            return False
+        col_offset = (x0-grid[1]) / dx
+        row_offset = (y0-grid[3]) / dy
+        if abs(col_offset-round(col_offset)) > 1e-3 or abs(row_offset-round(row_offset)) > 1e-3:
+            return False
+    return True
+
 def tile_directory(directory: str, output_filepath=None):
     if not output_filepath:
         base_directory = osp.basename(directory)
@@ -143,19 +278,124 @@ def tile_directory(directory: str, output_filepath=None):
     filenames = os.listdir(directory)
     filepaths = [osp.join(directory, filename) for filename in filenames]
     print(f'tiling rasters in directory {directory} ...')
-    gdal.Warp(
-        destNameOrDestDS=output_filepath,
-        srcDSOrSrcDSTab=filepaths,
-        format='GTiff',
-        resampleAlg='bilinear',
-        creationOptions=[
-            'COMPRESS=ZSTD', 'TILED=YES'
-        ]
-    )
+    if is_grid_aligned(filepaths):
+        # inputs share one pixel grid (see `reproject_directory(resolution=...)`), so blocks are copied without resampling
+        input_raster = gdal.Open(filepaths[0])
+        nodata_value = input_raster.GetRasterBand(1).GetNoDataValue()
+        if nodata_value is None:
+            nodata_value = NBR_NODATA
+        del input_raster
+        mosaic = gdal.BuildVRT('', filepaths, srcNodata=nodata_value, VRTNodata=nodata_value)
+        gdal.Translate(
+            output_filepath,
+            mosaic,
+            format='GTiff',
+            creationOptions=[
+                'COMPRESS=ZSTD', 'TILED=YES', 'NUM_THREADS=ALL_CPUS'
+            ]
+        )
+        del mosaic
+    else:
+        gdal.Warp(
+            destNameOrDestDS=output_filepath,
+            srcDSOrSrcDSTab=filepaths,
+            format='GTiff',
+            resampleAlg='bilinear',
+            creationOptions=[
+                'COMPRESS=ZSTD', 'TILED=YES'
+            ]
+        )
     print(f'successfully saved tiled raster to file {output_filepath}')
     return output_filepath
 
-def clip_raster(input_filepath, output_filepath=None, aoi_geojson_path=None):
+def offset_geotransform(geoTransform, col_off, row_off):
+    x0, dx, rx, y0, ry, dy = geoTransform
+    return (x0 + col_off*dx + row_off*rx, dx, rx, y0 + col_off*ry + row_off*dy, ry, dy)
+
+def get_mask_key(aoi_geojson_path, geoTransform, projection, shape):
+    key = hashlib.sha256()
+    with open(aoi_geojson_path, 'rb') as f:
+        key.update(f.read())
+    key.update(json.dumps([list(geoTransform), projection, list(shape)]).encode())
+    return key.hexdigest()
+
+def get_cutline_mask(aoi_geojson_path, geoTransform, projection, shape, mask_directory, strip_rows=1024):
+    '''
+    rasterize an AOI onto a grid (geoTransform, projection, (rows, cols)) once and cache it in `mask_directory`.
+    returns the mask bit-packed along x (one packed row per raster row) and
+    the (col_off, row_off, xsize, ysize) window covering the AOI
+    '''
+    mask_key = get_mask_key(aoi_geojson_path, geoTransform, projection, shape)
+    mask_filepath = osp.join(mask_directory, mask_key+'.npz')
+    if osp.exists(mask_filepath):
+        with np.load(mask_filepath) as cached_mask:
+            return cached_mask['mask'], tuple(int(v) for v in cached_mask['window'])
+    os.makedirs(mask_directory, exist_ok=True)
+    rows, cols = shape
+    packed_mask = np.zeros((rows, (cols+7)//8), dtype=np.uint8)
+    aoi = gdal.OpenEx(aoi_geojson_path, gdal.OF_VECTOR)
+    driver = gdal.GetDriverByName('MEM')
+    # rasterize in strips so the full-resolution byte mask never has to fit in memory
+    for row_off in range(0, rows, strip_rows):
+        strip_height = min(strip_rows, rows-row_off)
+        strip = driver.Create('', cols, strip_height, 1, gdal.GDT_Byte)
+        strip.SetGeoTransform(offset_geotransform(geoTransform, 0, row_off))
+        strip.SetProjection(projection)
+        gdal.Rasterize(strip, aoi, burnValues=[1])
+        packed_mask[row_off:row_off+strip_height] = np.packbits(strip.GetRasterBand(1).ReadAsArray() > 0, axis=1)
+        del strip
+    del aoi
+    row_any = np.flatnonzero(packed_mask.any(axis=1))
+    col_any = np.flatnonzero(np.unpackbits(np.bitwise_or.reduce(packed_mask, axis=0), count=cols))
+    if len(row_any):
+        window = (int(col_any[0]), int(row_any[0]), int(col_any[-1]-col_any[0]+1), int(row_any[-1]-row_any[0]+1))
+    else:
+        window = (0, 0, 0, 0)
+    # write then rename so concurrent clips never read a partial mask
+    tmp_filepath = mask_filepath+f'.{os.getpid()}.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        np.savez_compressed(f, mask=packed_mask, window=np.array(window))
+    os.replace(tmp_filepath, mask_filepath)
+    return packed_mask, window
+
+def unpack_mask_window(packed_mask, col_off, row_off, xsize, ysize):
+    first_byte = col_off // 8
+    last_byte = (col_off+xsize+7) // 8
+    mask = np.unpackbits(packed_mask[row_off:row_off+ysize, first_byte:last_byte], axis=1)
+    start = col_off - first_byte*8
+    return mask[:, start:start+xsize].astype(bool)
+
+def apply_cutline_mask(input_filepath, output_filepath, packed_mask, window, nodata_value, strip_rows=512):
+    '''
+    crop a raster to `window` and set every pixel outside the packed mask to `nodata_value`,
+    streaming strips of `strip_rows` rows
+    '''
+    col_off, row_off, xsize, ysize = window
+    input_raster = gdal.Open(input_filepath)
+    input_band = input_raster.GetRasterBand(1)
+    driver = gdal.GetDriverByName('GTiff')
+    output_raster = driver.Create(
+        output_filepath,
+        xsize,
+        ysize,
+        1,
+        input_band.DataType,
+        options=['COMPRESS=ZSTD', 'TILED=YES'])
+    output_raster.SetGeoTransform(offset_geotransform(input_raster.GetGeoTransform(), col_off, row_off))
+    output_raster.SetProjection(input_raster.GetProjection())
+    output_band = output_raster.GetRasterBand(1)
+    output_band.SetNoDataValue(nodata_value)
+    for strip_off in range(0, ysize, strip_rows):
+        strip_height = min(strip_rows, ysize-strip_off)
+        data = input_band.ReadAsArray(col_off, row_off+strip_off, xsize, strip_height)
+        mask = unpack_mask_window(packed_mask, col_off, row_off+strip_off, xsize, strip_height)
+        data[~mask] = nodata_value
+        output_band.WriteArray(data, 0, strip_off)
+    output_raster.FlushCache()
+    del output_raster
+    del input_raster
+
+def clip_raster(input_filepath, output_filepath=None, aoi_geojson_path=None, mask_directory=None):
     if not aoi_geojson_path:
         print('please provide a path to a geojson')
         return input_filepath
@@ -171,7 +411,24 @@ def clip_raster(input_filepath, output_filepath=None, aoi_geojson_path=None):
     band = input_raster.GetRasterBand(1)
     nodata_value = band.GetNoDataValue()
     if nodata_value is None:
-        nodata_value=-20000
+        nodata_value = NBR_NODATA
+    if mask_directory:
+        # reuse the AOI mask rasterized for this grid instead of re-evaluating the cutline
+        shape = (input_raster.RasterYSize, input_raster.RasterXSize)
+        packed_mask, window = get_cutline_mask(
+            aoi_geojson_path,
+            input_raster.GetGeoTransform(),
+            input_raster.GetProjection(),
+            shape,
+            mask_directory
+        )
+        del input_raster
+        if window[2] == 0:
+            print(f'{aoi_geojson_path} does not intersect raster in file {input_filepath}')
+            return input_filepath
+        apply_cutline_mask(input_filepath, output_filepath, packed_mask, window, nodata_value)
+        print(f'successfully saved clipped raster to file {output_filepath}')
+        return output_filepath
     del input_raster
     gdal.Warp(
         output_filepath,  # Output file
@@ -190,16 +447,34 @@ def clip_raster(input_filepath, output_filepath=None, aoi_geojson_path=None):
     print(f'successfully saved clipped raster to file {output_filepath}')
     return output_filepath
 
-def plot_raster(filepath, cmap='magma'):
+def build_overviews(filepath, resampling='AVERAGE', min_size=256):
+    raster = gdal.Open(filepath)
+    if raster.GetRasterBand(1).GetOverviewCount() == 0:
+        factors = []
+        factor = 2
+        while max(raster.RasterXSize, raster.RasterYSize) / factor >= min_size:
+            factors.append(factor)
+            factor *= 2
+        if factors:
+            print(f'building overviews for file {filepath} ...')
+            raster.BuildOverviews(resampling, factors, options=['COMPRESS_OVERVIEW=ZSTD'])
+    del raster
+
+def plot_raster(filepath, cmap='magma', max_size=2048):
     if not osp.exists(filepath):
         print(f'file {filepath} does not exist')
         return
     raster = gdal.Open(filepath)
     band = raster.GetRasterBand(1)
-    band_data = band.ReadAsArray()
+    # read a decimated copy (served from overviews when present) instead of the full band
+    scale = max(band.XSize, band.YSize) / max_size
+    if scale > 1:
+        band_data = band.ReadAsArray(buf_xsize=int(band.XSize/scale), buf_ysize=int(band.YSize/scale))
+    else:
+        band_data = band.ReadAsArray()
     nodata_value = band.GetNoDataValue()
     if nodata_value is None:
-        nodata_value = -20000 # this is the standard for USGS NBR
+        nodata_value = NBR_NODATA
     del band
     del raster
     masked_band_data = np.ma.masked_equal(band_data, nodata_value)
@@ -0,0 +1,138 @@
+import os.path as osp
+from collections import Counter
+
+import pytest
+
+import api
+import downloader
+from api import M2M
+
+class ScriptedM2M(M2M):
+    """
+    M2M whose service is a script: of the requested products, one is available right away,
+    the others are released one per download-retrieve call, and the last one is only ever
+    listed under 'requested' (first without and then with a url).
+    """
+
+    def __init__(self, entityIds, neverAvailable=False):
+        self.neverAvailable = neverAvailable
+        self.datasetNames = ['landsat_ot_c2_l2']
+        self.entityIds = entityIds
+        self.downloadIds = [str(1000+i) for i in range(len(entityIds))]
+        self.retrieveCalls = 0
+        self.removedLabels = []
+        self.requestLabels = set()
+
+    def download(self, i):
+        return {'downloadId': int(self.downloadIds[i]), 'url': f'https://example.com/{self.downloadIds[i]}', 'entityId': self.entityIds[i]}
+
+    def sendRequest(self, endpoint, data={}, max_retries=5):
+        if 'label' in data or 'listId' in data:
+            self.requestLabels.add((endpoint, data.get('label', data.get('listId'))))
+        if endpoint == 'scene-list-add':
+            return None
+        if endpoint == 'download-options':
+            return [{'entityId': entityId, 'id': f'product-{entityId}', 'downloadSystem': 'dds', 'available': True} for entityId in self.entityIds]
+        if endpoint == 'download-request':
+            return {
+                'availableDownloads': [self.download(0)],
+                'duplicateProducts': [],
+                'preparingDownloads': [{'downloadId': int(idD)} for idD in self.downloadIds[1:]],
+                'failed': [],
+                'newRecords': {idD: data['label'] for idD in self.downloadIds},
+                'numInvalidScenes': 0
+            }
+        if endpoint == 'download-search':
+            return [
+                {'downloadId': int(idD), 'displayId': f'LC08_L2SP_042034_202008{10+i}_20200919_02_T1_SR_B5'}
+                for i, idD in enumerate(self.downloadIds)
+            ]
+        if endpoint == 'download-retrieve':
+            self.retrieveCalls += 1
+            last = len(self.downloadIds) - 1
+            released = min(1 + self.retrieveCalls, last)
+            # downloads already handed off keep showing up in every response
+            available = [self.download(i) for i in range(released)]
+            requested = [self.download(last) if self.retrieveCalls >= 3 and not self.neverAvailable else {'downloadId': int(self.downloadIds[last]), 'url': None}]
+            return {'available': available, 'requested': requested}
+        if endpoint == 'download-order-remove':
+            self.removedLabels.append(data['label'])
+            return None
+        raise AssertionError(f'unexpected endpoint {endpoint}')
+
+@pytest.fixture
+def failing():
+    # download ids whose download raises
+    return set()
+
+@pytest.fixture
+def downloads(monkeypatch, failing):
+    downloaded = Counter()
+    def download_url(url, local_path, scheduler=None, **args):
+        idD = osp.basename(url)
+        downloaded[idD] += 1
+        if idD in failing:
+            raise downloader.DownloadError(f'download_url - failed to download file {url}')
+        with open(local_path, 'wb') as f:
+            f.write(b'tar')
+        with open(local_path + '.size', 'w') as f:
+            f.write('3')
+    monkeypatch.setattr(downloader, 'download_url', download_url)
+    return downloaded
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+    monkeypatch.setattr(api, 'poll_min_seconds', 0.01)
+    monkeypatch.setattr(api, 'poll_max_seconds', 0.04)
+    # sleeps are skipped, so a download that never shows up would otherwise poll for the full timeout
+    monkeypatch.setattr(api, 'poll_timeout_seconds', 2)
+    monkeypatch.setattr(api.time, 'sleep', slept.append)
+    return slept
+
+def test_retrieve_scenes_downloads_each_release_once(downloads, sleeps, tmp_path):
+    entityIds = [f'LC80420342020{220+i}LGN00' for i in range(5)]
+    m2m = ScriptedM2M(entityIds)
+    downloadMeta = m2m.retrieveScenes('landsat_ot_c2_l2', {'results': [{'entityId': e} for e in entityIds]}, acq_directory=str(tmp_path))
+    assert downloads == Counter({idD: 1 for idD in m2m.downloadIds})
+    assert m2m.retrieveCalls == len(entityIds) - 2
+    assert len(sleeps) == m2m.retrieveCalls - 1
+    assert all(seconds <= api.poll_max_seconds for seconds in sleeps)
+    for idD in m2m.downloadIds:
+        assert downloadMeta[idD]['local_path'] == osp.join(str(tmp_path), downloadMeta[idD]['displayId']+'.tar')
+    assert m2m.removedLabels == ['m2m-api_download']
+    assert not any('error' in meta for meta in downloadMeta.values())
+
+def test_merge_outputs_treats_empty_containers_as_absent():
+    outputs = [
+        {'duplicateProducts': [], 'newRecords': {'1': 'a'}, 'availableDownloads': [{'downloadId': 1}], 'numInvalidScenes': 0},
+        {'duplicateProducts': {'2': 'b'}, 'newRecords': [], 'availableDownloads': [], 'numInvalidScenes': 2},
+        {'duplicateProducts': [], 'newRecords': {'3': 'c'}, 'availableDownloads': [{'downloadId': 3}], 'numInvalidScenes': 1},
+    ]
+    assert api.merge_outputs(outputs) == {
+        'duplicateProducts': {'2': 'b'},
+        'newRecords': {'1': 'a', '3': 'c'},
+        'availableDownloads': [{'downloadId': 1}, {'downloadId': 3}],
+        'numInvalidScenes': 3
+    }
+    assert api.merge_outputs([{'duplicateProducts': []}, {'duplicateProducts': []}]) == {'duplicateProducts': []}
+
+def test_retrieve_scenes_uses_the_given_label(downloads, sleeps, tmp_path):
+    label = 'get-nbr_042034_20200815'
+    entityIds = [f'LC80420342020{220+i}LGN00' for i in range(3)]
+    m2m = ScriptedM2M(entityIds)
+    m2m.retrieveScenes('landsat_ot_c2_l2', {'results': [{'entityId': e} for e in entityIds]}, label=label, acq_directory=str(tmp_path))
+    assert downloads == Counter({idD: 1 for idD in m2m.downloadIds})
+    endpoints = {'scene-list-add', 'download-options', 'download-request', 'download-search', 'download-retrieve', 'download-order-remove'}
+    assert m2m.requestLabels == {(endpoint, label) for endpoint in endpoints}
+    assert m2m.removedLabels == [label]
+
+def test_retrieve_scenes_marks_failed_and_unavailable_downloads(downloads, failing, sleeps, monkeypatch, tmp_path):
+    monkeypatch.setattr(api, 'poll_timeout_seconds', 0.2)
+    entityIds = [f'LC80420342020{220+i}LGN00' for i in range(4)]
+    m2m = ScriptedM2M(entityIds, neverAvailable=True)
+    unavailable = m2m.downloadIds[-1]
+    failing.add(m2m.downloadIds[1])
+    downloadMeta = m2m.retrieveScenes('landsat_ot_c2_l2', {'results': [{'entityId': e} for e in entityIds]}, acq_directory=str(tmp_path))
+    assert {idD: meta['error'] for idD, meta in downloadMeta.items() if 'error' in meta} == {m2m.downloadIds[1]: 'download failed', unavailable: 'not available'}
+    assert unavailable not in downloads
@@ -0,0 +1,95 @@
+import os.path as osp
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+import downloader
+from downloader import DownloadScheduler, DownloadError, download_url
+
+file_bytes = 256 * 1024
+send_chunk_bytes = 16 * 1024
+send_chunk_seconds = 0.005
+truncated_declared_bytes = 100 * 1000
+truncated_sent_bytes = 1000
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    """
+    /file/<n> sends file_bytes in small, delayed chunks, /truncated declares
+    truncated_declared_bytes but closes the connection after truncated_sent_bytes.
+    """
+
+    def do_GET(self):
+        if self.path.startswith('/file/'):
+            body = bytes([int(self.path.split('/')[-1]) % 256]) * file_bytes
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            for start in range(0, len(body), send_chunk_bytes):
+                self.wfile.write(body[start:start+send_chunk_bytes])
+                self.wfile.flush()
+                time.sleep(send_chunk_seconds)
+        elif self.path == '/truncated':
+            self.send_response(200)
+            self.send_header('Content-Length', str(truncated_declared_bytes))
+            self.end_headers()
+            self.wfile.write(b'x' * truncated_sent_bytes)
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_scheduler_downloads_every_file(server, tmp_path):
+    with DownloadScheduler(max_threads=4, control_interval=0.1) as scheduler:
+        futures = [scheduler.submit(f'{server}/file/{i}', str(tmp_path / f'{i}.tar'), priority=(i,)) for i in range(6)]
+    for i, future in enumerate(futures):
+        local_path = future.result()
+        with open(local_path, 'rb') as f:
+            assert f.read() == bytes([i]) * file_bytes
+        assert open(local_path + '.size').read() == str(file_bytes)
+    assert scheduler.bytes == 6 * file_bytes
+    assert scheduler.errors == 0
+
+def test_scheduler_respects_bandwidth_limit(server, tmp_path):
+    bandwidth_limit = 512 * 1024
+    count = 4
+    start = time.time()
+    with DownloadScheduler(max_threads=4, bandwidth_limit=bandwidth_limit, control_interval=0.1) as scheduler:
+        for i in range(count):
+            scheduler.submit(f'{server}/file/{i}', str(tmp_path / f'{i}.tar'))
+    elapsed = time.time() - start
+    # up to bandwidth_burst_seconds worth of bytes may go out without waiting
+    assert elapsed >= (count * file_bytes - bandwidth_limit) / bandwidth_limit * 0.9
+    assert scheduler.bytes == count * file_bytes
+
+def test_scheduler_defaults_to_module_bandwidth_limit(monkeypatch):
+    monkeypatch.setattr(downloader, 'bandwidth_limit_bytes', 1024)
+    with DownloadScheduler(max_threads=1, control_interval=0.1) as scheduler:
+        assert scheduler.bandwidth_limit == 1024
+    with DownloadScheduler(max_threads=1, bandwidth_limit=2048, control_interval=0.1) as scheduler:
+        assert scheduler.bandwidth_limit == 2048
+
+def test_truncated_download_is_retried_then_removed(server, tmp_path):
+    local_path = str(tmp_path / 'truncated.tar')
+    scheduler = DownloadScheduler(max_threads=1, control_interval=0.1)
+    try:
+        with pytest.raises(DownloadError):
+            download_url(f'{server}/truncated', local_path, max_retries=2, sleep_seconds=0, scheduler=scheduler)
+    finally:
+        scheduler.close()
+    assert scheduler.errors == 3
+    assert not osp.exists(local_path)
+    assert not osp.exists(local_path + '.size')
@@ -0,0 +1,274 @@
+import os
+import os.path as osp
+import io
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+from PIL import Image
+from matplotlib import colormaps
+from osgeo import gdal
+
+from raster_utils import NBR_NODATA, build_overviews
+gdal.UseExceptions()
+
+WEB_MERCATOR_EXTENT = 20037508.342789244
+tile_size = 256
+memory_cache_bytes = 256 * 2**20
+disk_cache_bytes = 2 * 2**30
+content_types = {'png': 'image/png', 'webp': 'image/webp'}
+
+def tile_bounds(z, x, y):
+    """
+    Bounds (min_x, min_y, max_x, max_y) in EPSG:3857 of XYZ tile z/x/y.
+    """
+    size = 2 * WEB_MERCATOR_EXTENT / 2**z
+    min_x = -WEB_MERCATOR_EXTENT + x * size
+    max_y = WEB_MERCATOR_EXTENT - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+class TileCache(object):
+    """
+    Size-bounded LRU cache of rendered tiles, in memory and optionally on disk.
+
+    On disk, recency is tracked with file modification times, which are bumped on every hit.
+    """
+
+    def __init__(self, cache_directory=None, max_memory_bytes=memory_cache_bytes, max_disk_bytes=disk_cache_bytes):
+        self.cache_directory = cache_directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = None
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            tile = self.memory.get(key)
+            if tile is not None:
+                self.memory.move_to_end(key)
+                return tile
+        if self.cache_directory is None:
+            return None
+        tile_path = osp.join(self.cache_directory, key)
+        try:
+            with open(tile_path, 'rb') as f:
+                tile = f.read()
+            os.utime(tile_path)
+        except OSError:
+            return None
+        self.put_memory(key, tile)
+        return tile
+
+    def put(self, key, tile):
+        self.put_memory(key, tile)
+        if self.cache_directory is not None:
+            self.put_disk(key, tile)
+
+    def put_memory(self, key, tile):
+        with self.lock:
+            if key in self.memory:
+                self.memory_bytes -= len(self.memory.pop(key))
+            self.memory[key] = tile
+            self.memory_bytes += len(tile)
+            while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+    def put_disk(self, key, tile):
+        tile_path = osp.join(self.cache_directory, key)
+        os.makedirs(osp.dirname(tile_path), exist_ok=True)
+        tmp_path = tile_path + f'.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(tile)
+        os.replace(tmp_path, tile_path)
+        with self.lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = sum(size for _, _, size in self.disk_entries())
+            else:
+                self.disk_bytes += len(tile)
+            if self.disk_bytes > self.max_disk_bytes:
+                self.evict_disk()
+
+    def disk_entries(self):
+        for root, _, filenames in os.walk(self.cache_directory):
+            for filename in filenames:
+                path = osp.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def evict_disk(self):
+        # evict down to 90% of the budget so eviction does not run on every insert
+        entries = sorted(self.disk_entries(), key=lambda entry: entry[1])
+        self.disk_bytes = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self.disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
+
+class TileRenderer(object):
+    """
+    Render colormapped XYZ tiles from single band rasters.
+
+    Each tile is warped from the window and overview level of the raster it covers,
+    so no request reads more than roughly one tile's worth of pixels.
+    """
+
+    def __init__(self, layers, cmap='magma', vmin=-10000, vmax=10000, cache=None, tile_format='png'):
+        if tile_format not in content_types:
+            raise ValueError(f'tile format {tile_format} not one of {list(content_types)}')
+        self.cmap = cmap
+        self.vmin = vmin
+        self.vmax = vmax
+        self.tile_format = tile_format
+        self.cache = cache if cache is not None else TileCache()
+        self.colors = (colormaps[cmap](np.linspace(0, 1, 256)) * 255).astype('uint8')
+        # open datasets not in use by any thread, GDAL datasets must not be used by two threads at once
+        self.datasets = {}
+        self.datasets_lock = threading.Lock()
+        self.layers = {}
+        for name, filepath in layers.items():
+            self.add_layer(name, filepath)
+
+    def add_layer(self, name, filepath):
+        build_overviews(filepath)
+        raster = gdal.Open(filepath)
+        nodata_value = raster.GetRasterBand(1).GetNoDataValue()
+        if nodata_value is None:
+            nodata_value = NBR_NODATA
+        warped = gdal.Warp('', raster, format='VRT', dstSRS='EPSG:3857')
+        x0, dx, _, y0, _, dy = warped.GetGeoTransform()
+        bounds = (x0, y0 + dy*warped.RasterYSize, x0 + dx*warped.RasterXSize, y0)
+        del warped
+        del raster
+        style = json.dumps([filepath, osp.getmtime(filepath), self.cmap, self.vmin, self.vmax])
+        with self.datasets_lock:
+            self.datasets.pop(name, None)
+        self.layers[name] = {
+            'filepath': filepath,
+            'nodata_value': nodata_value,
+            'bounds': bounds,
+            'style': hashlib.sha256(style.encode()).hexdigest()[:16]
+        }
+
+    def open_layer(self, name):
+        # the server runs every request on a new thread, so datasets are pooled rather than kept per thread
+        with self.datasets_lock:
+            datasets = self.datasets.setdefault(name, [])
+            if datasets:
+                return datasets.pop()
+        return gdal.Open(self.layers[name]['filepath'])
+
+    def release_layer(self, name, dataset):
+        with self.datasets_lock:
+            self.datasets.setdefault(name, []).append(dataset)
+
+    def render(self, name, z, x, y):
+        if name not in self.layers:
+            raise KeyError(name)
+        layer = self.layers[name]
+        key = f"{name}/{layer['style']}/{z}/{x}/{y}.{self.tile_format}"
+        tile = self.cache.get(key)
+        if tile is not None:
+            return tile
+        bounds = tile_bounds(z, x, y)
+        min_x, min_y, max_x, max_y = layer['bounds']
+        if bounds[0] >= max_x or bounds[2] <= min_x or bounds[1] >= max_y or bounds[3] <= min_y:
+            data = np.full((tile_size, tile_size), layer['nodata_value'])
+        else:
+            dataset = self.open_layer(name)
+            try:
+                warped = gdal.Warp(
+                    '',
+                    dataset,
+                    format='MEM',
+                    dstSRS='EPSG:3857',
+                    outputBounds=bounds,
+                    width=tile_size,
+                    height=tile_size,
+                    srcNodata=layer['nodata_value'],
+                    dstNodata=layer['nodata_value'],
+                    resampleAlg='average'
+                )
+                data = warped.GetRasterBand(1).ReadAsArray()
+                del warped
+            finally:
+                self.release_layer(name, dataset)
+        tile = self.encode(data, layer['nodata_value'])
+        self.cache.put(key, tile)
+        return tile
+
+    def encode(self, data, nodata_value):
+        scaled = (data.astype('float32') - self.vmin) / (self.vmax - self.vmin)
+        indices = np.clip(np.round(scaled * 255), 0, 255).astype('uint8')
+        rgba = self.colors[indices]
+        rgba[data == nodata_value, 3] = 0
+        buffer = io.BytesIO()
+        Image.fromarray(rgba, 'RGBA').save(buffer, format=self.tile_format.upper())
+        return buffer.getvalue()
+
+def make_handler(renderer):
+    class TileHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if parts == ['']:
+                index = {
+                    name: f'http://{self.headers.get("Host")}/{name}/{{z}}/{{x}}/{{y}}.{renderer.tile_format}'
+                    for name in renderer.layers
+                }
+                self.respond(200, 'application/json', json.dumps(index).encode())
+                return
+            try:
+                name, z, x, tile_name = parts
+                y, extension = tile_name.split('.')
+                z, x, y = int(z), int(x), int(y)
+                if extension != renderer.tile_format or not (0 <= x < 2**z and 0 <= y < 2**z):
+                    raise ValueError(tile_name)
+                tile = renderer.render(name, z, x, y)
+            except (ValueError, KeyError):
+                self.respond(404, 'text/plain', b'not found')
+                return
+            self.respond(200, content_types[renderer.tile_format], tile)
+
+        def respond(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.info('serve_tiles - ' + format % args)
+
+    return TileHandler
+
+def serve_tiles(layers, host='127.0.0.1', port=8000, cache_directory=None, **renderer_args):
+    """
+    Serve XYZ tiles at http://<host>:<port>/<layer>/{z}/{x}/{y}.png until interrupted.
+
+    :param layers: dictionary mapping layer names to raster file paths
+    :param cache_directory: directory for the on-disk tile cache, tiles are only cached in memory if None
+    :param renderer_args: extra arguments for TileRenderer (cmap, vmin, vmax, tile_format)
+    """
+    renderer = TileRenderer(layers, cache=TileCache(cache_directory), **renderer_args)
+    server = ThreadingHTTPServer((host, port), make_handler(renderer))
+    print(f'serving tiles for {list(layers)} at http://{host}:{port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()